@@ -87,6 +87,27 @@ def connect_kik_api_signals():
                                 sender=user,
                                 dispatch_uid='kik_user_delete_cache')
 
+
+def connect_states_signals():
+    from . import signals as handlers
+    state = apps.get_model("permabots", "State")
+    signals.post_save.connect(handlers.delete_cache,
+                              sender=state,
+                              dispatch_uid='state_delete_cache')
+    signals.post_delete.connect(handlers.delete_cache,
+                                sender=state,
+                                dispatch_uid='state_delete_cache')
+    for model_name in ("TelegramChatState", "KikChatState", "MessengerChatState"):
+        sender = apps.get_model("permabots", model_name)
+        signals.pre_save.connect(handlers.delete_previous_chat_state,
+                                 sender=sender,
+                                 dispatch_uid='%s_delete_previous_cache' % model_name.lower())
+        signals.post_save.connect(handlers.set_chat_state,
+                                  sender=sender,
+                                  dispatch_uid='%s_set_cache' % model_name.lower())
+        signals.post_delete.connect(handlers.delete_chat_state,
+                                    sender=sender,
+                                    dispatch_uid='%s_delete_cache' % model_name.lower())
     
 def connect_environment_vars_signals():
     from . import signals as handlers
@@ -115,6 +136,25 @@ def connect_source_states_signals():
                                 sender=handler.source_states.through,
                                 dispatch_uid='source_states_related_to_handler_delete_cache')
 
+def connect_requests_signals():
+    from . import signals as handlers
+    for model_name in ("Request", "UrlParam", "HeaderParam"):
+        sender = apps.get_model("permabots", model_name)
+        signals.post_save.connect(handlers.delete_cache_requests,
+                                  sender=sender,
+                                  dispatch_uid='%s_related_to_handler_delete_cache' % model_name.lower())
+        # Handlers lose their request before it is deleted
+        signals.pre_delete.connect(handlers.delete_cache_requests,
+                                   sender=sender,
+                                   dispatch_uid='%s_related_to_handler_delete_cache' % model_name.lower())
+
+def connect_responses_signals():
+    from . import signals as handlers
+    response = apps.get_model("permabots", "Response")
+    signals.post_save.connect(handlers.delete_cache_responses,
+                              sender=response,
+                              dispatch_uid='response_related_to_handler_delete_cache')
+
 class PermabotsAppConfig(AppConfig):
     name = "permabots"
     verbose_name = "Permabots"
@@ -126,6 +166,9 @@ class PermabotsAppConfig(AppConfig):
         connect_messenger_bot_signals()
         connect_telegram_api_signals()
         connect_kik_api_signals()
+        connect_states_signals()
         connect_environment_vars_signals()
         connect_handlers_signals()
         connect_source_states_signals()
+        connect_requests_signals()
+        connect_responses_signals()
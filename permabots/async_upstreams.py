@@ -0,0 +1,82 @@
+# -*- coding: utf-8 -*-
+from permabots import upstreams
+from permabots.upstreams import UpstreamError
+import asyncio
+import weakref
+import httpx
+
+#  Optional module for async workers. Requires python 3.7 and httpx, so it is only imported from async code and never
+#  from the rest of the package, which keeps running in every supported interpreter.
+
+#  Semaphores and clients are bound to the event loop they are used in. Entries of a loop are dropped with it
+_semaphores = weakref.WeakKeyDictionary()
+_clients = weakref.WeakKeyDictionary()
+
+
+def _semaphore(host):
+    semaphores = _semaphores.setdefault(asyncio.get_running_loop(), {})
+    if host not in semaphores:
+        semaphores[host] = asyncio.Semaphore(upstreams.get_host_concurrency())
+    return semaphores[host]
+
+async def _close_on_shutdown(client):
+    #  Async generators are closed by loop.shutdown_asyncgens, i.e. when asyncio.run finishes, before the loop is closed
+    try:
+        yield
+    finally:
+        await client.aclose()
+
+async def _client():
+    #  Keep-alive connections are pooled by event loop and closed with it
+    loop = asyncio.get_running_loop()
+    if loop not in _clients:
+        client = httpx.AsyncClient()
+        closing = _close_on_shutdown(client)
+        _clients[loop] = (client, closing)
+        await closing.__anext__()
+    return _clients[loop][0]
+
+async def request(method, url, timeout=None, **kwargs):
+    """
+    Perform http request with httpx. Same timeout, host concurrency cap and circuit breaker than
+    :func:`permabots.upstreams.request`. Concurrency is capped and connections are pooled for each event loop.
+    Connections are closed when the loop shuts down its async generators, i.e. at the end of asyncio.run.
+
+    :returns: `httpx.Response <https://www.python-httpx.org/api/#response>` _.
+    :raises UpstreamError: when circuit is open, host is busy, request times out or connection fails
+    """
+    timeout = upstreams.get_timeout(timeout)
+    host = upstreams._host(url)
+    failures = upstreams._check(host)
+    semaphore = _semaphore(host)
+    try:
+        await asyncio.wait_for(semaphore.acquire(), upstreams._connect_timeout(timeout))
+    except asyncio.TimeoutError:
+        raise UpstreamError(503, "Too many concurrent requests to %s" % host)
+    try:
+        if isinstance(timeout, (tuple, list)):
+            timeout = httpx.Timeout(timeout[1], connect=timeout[0])
+        client = await _client()
+        response = await client.request(method, url, timeout=timeout, **kwargs)
+    except httpx.TimeoutException:
+        upstreams._record(host, failures, True)
+        raise UpstreamError(504, "Request to %s timed out" % host)
+    except httpx.TransportError:
+        upstreams._record(host, failures, True)
+        raise UpstreamError(502, "Connection to %s failed" % host)
+    finally:
+        semaphore.release()
+    upstreams._record(host, failures, response.status_code >= 500)
+    return response
+
+async def process(handler_request, bot_timeout=None, **context):
+    """
+    Process handler request from async workers. Same as :meth:`Request.process <permabots.models.Request.process>`
+    without response caching.
+
+    :param handler_request: :class:`Request <permabots.models.Request>` with its parameters already loaded
+    :returns: `httpx.Response <https://www.python-httpx.org/api/#response>` _.
+    """
+    url, kwargs = handler_request._build(**context)
+    timeout = upstreams.get_timeout(handler_request.timeout, bot_timeout)
+    return await request(handler_request._get_method(), url, timeout=timeout, **kwargs)
@@ -14,6 +14,21 @@ def get_or_set(model, pk):
         cache.set(key, obj)
     return obj
 
+def get_or_set_many(model, pks):
+    """
+    Obtain several objects with one cache request. Missing ones are loaded from database with one query.
+
+    :returns: list of objects in the same order of pks. Objects not found are not included
+    """
+    keys = [generate_key(model, pk) for pk in pks]
+    cached = cache.get_many(keys)
+    missing = [pk for pk, key in zip(pks, keys) if key not in cached]
+    if missing:
+        objs = model.objects.in_bulk(missing)
+        set_many(objs.values())
+        cached.update((generate_key(model, pk), obj) for pk, obj in objs.items())
+    return [cached[key] for key in keys if key in cached]
+
 def get(model, pk):
     key = generate_key(model, pk)
     return cache.get(key)
@@ -26,6 +41,12 @@ def set(obj):
     key = generate_key(obj._meta.model, obj.pk)
     cache.set(key, obj)
     
+def set_many(objs):
+    cache.set_many({generate_key(obj._meta.model, obj.pk): obj for obj in objs})
+    
+def delete_many(model, instances):
+    cache.delete_many([generate_key(model, instance.pk) for instance in instances])
+    
 def get_or_set_related(instance, related, *args):
     key = generate_key(instance._meta.model, instance.pk, related)
     objs = cache.get(key)
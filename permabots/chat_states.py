@@ -0,0 +1,80 @@
+# -*- coding: utf-8 -*-
+from django.core.cache import cache
+from permabots import caching
+from permabots.models import State
+import logging
+
+logger = logging.getLogger(__name__)
+
+#  Chat states are read for every message. They are kept in cache by bot, chat and user and written through
+#  when a handler changes them. Chats without state are cached too, so first contact users do not query
+#  the database for each message until their chat state is created.
+
+NO_CHAT_STATE = False
+
+
+def _pk(obj):
+    return getattr(obj, 'pk', obj)
+
+def generate_key(model, bot_id, chat, user=None):
+    return caching.generate_key(model, '%s:%s:%s' % (bot_id, _pk(chat), _pk(user)))
+
+def _instance_key(chat_state):
+    user = chat_state.serializable_value('user') if hasattr(chat_state, 'user_id') else None
+    return generate_key(chat_state._meta.model, chat_state.state.bot_id, chat_state.serializable_value('chat'), user)
+
+def _build(model, entry, chat, user):
+    fields = {'chat': chat}
+    if user is not None:
+        fields['user'] = user
+    chat_state = model(id=entry['id'],
+                       state=caching.get_or_set(State, entry['state_id']),
+                       context=entry['context'],
+                       version=entry['version'],
+                       created_at=entry['created_at'],
+                       updated_at=entry['updated_at'],
+                       **fields)
+    chat_state._state.adding = False
+    return chat_state
+
+def get(model, bot, chat, user=None):
+    """
+    Obtain chat state of a chat from cache. It is loaded from database and cached when not found.
+
+    :param model: Chat state model of the integration. i.e. :class:`TelegramChatState <permabots.models.state.TelegramChatState>`
+    :param bot: Bot
+    :param chat: Chat instance or identifier in the integration
+    :param user: User instance. None if chat states of the integration are not related to users
+    :returns: Chat state or None if chat has no state yet
+    """
+    key = generate_key(model, bot.pk, chat, user)
+    entry = cache.get(key)
+    if entry is None:
+        lookup = {'chat': chat, 'state__bot': bot}
+        if user is not None:
+            lookup['user'] = user
+        try:
+            chat_state = model.objects.select_related('state').get(**lookup)
+        except model.DoesNotExist:
+            cache.set(key, NO_CHAT_STATE)
+            return None
+        set(chat_state)
+        return chat_state
+    if entry is NO_CHAT_STATE:
+        return None
+    return _build(model, entry, chat, user)
+
+def set(chat_state):
+    """
+    Write chat state to cache. Its state is cached too as it is needed when chat state is read.
+    """
+    caching.set(chat_state.state)
+    cache.set(_instance_key(chat_state), {'id': chat_state.pk,
+                                          'state_id': chat_state.state_id,
+                                          'context': chat_state.context,
+                                          'version': chat_state.version,
+                                          'created_at': chat_state.created_at,
+                                          'updated_at': chat_state.updated_at})
+
+def delete(chat_state):
+    cache.delete(_instance_key(chat_state))
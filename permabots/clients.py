@@ -0,0 +1,44 @@
+# -*- coding: utf-8 -*-
+import threading
+import logging
+
+logger = logging.getLogger(__name__)
+
+#  Provider api clients live in process memory so they are neither built again for each message
+#  nor pickled with the integration bots kept in cache.
+_clients = {}
+_lock = threading.Lock()
+
+
+def generate_key(instance):
+    return '{}.{}-{}'.format(instance._meta.app_label, instance._meta.model_name, instance.pk)
+
+def get_or_set(instance, credentials, factory):
+    """
+    Obtain provider api client for an integration bot. It is built again when its credentials change.
+
+    :param instance: Integration bot :class:`IntegrationBot <permabots.models.bot.IntegrationBot>`
+    :param credentials: Tuple with the values required to build the client. i.e. token
+    :param factory: Callable returning a new client
+    :returns: Provider api client
+    """
+    if instance.pk is None:
+        return factory()
+    key = generate_key(instance)
+    with _lock:
+        entry = _clients.get(key)
+        if entry is not None and entry[0] == credentials:
+            return entry[1]
+    client = factory()
+    with _lock:
+        _clients[key] = (credentials, client)
+    logger.debug("Client for %s built" % key)
+    return client
+
+def delete(instance):
+    with _lock:
+        _clients.pop(generate_key(instance), None)
+
+def clear():
+    with _lock:
+        _clients.clear()
@@ -0,0 +1,130 @@
+# -*- coding: utf-8 -*-
+from django.conf import settings
+from requests.adapters import HTTPAdapter
+from telegram.utils.request import Request as TelegramRequest
+from kik import KikApi, KikError, Configuration
+from kik.api import ROOT_URL as KIK_ROOT_URL
+from messengerbot import MessengerClient, MessengerError, MessengerException
+import requests
+import json
+import threading
+import os
+import logging
+
+logger = logging.getLogger(__name__)
+
+#  Connections are pooled per process. Pools created before forking a worker are not reused by the child.
+_pid = None
+_session = None
+_telegram_request = None
+_lock = threading.Lock()
+
+DEFAULT_POOL = {'pool_connections': 10,
+                'pool_maxsize': 10,
+                'pool_block': False}
+
+
+def get_pool_settings():
+    pool = dict(DEFAULT_POOL)
+    pool.update(getattr(settings, 'MICROBOT_HTTP_POOL', {}))
+    return pool
+
+def _reset_if_forked():
+    global _pid, _session, _telegram_request
+    if _pid != os.getpid():
+        _pid = os.getpid()
+        _session = None
+        _telegram_request = None
+
+def get_session():
+    """
+    Obtain the keep-alive session shared by the process to perform http requests.
+
+    Its pools are configured with MICROBOT_HTTP_POOL: ``pool_connections`` hosts are kept,
+    each one with up to ``pool_maxsize`` connections. Set ``pool_block`` to never open more connections than that to a host.
+
+    :returns: `requests.Session <http://docs.python-requests.org/en/master/api/#requests.Session>` _.
+    """
+    global _session
+    with _lock:
+        _reset_if_forked()
+        if _session is None:
+            session = requests.Session()
+            adapter = HTTPAdapter(**get_pool_settings())
+            session.mount('https://', adapter)
+            session.mount('http://', adapter)
+            _session = session
+        return _session
+
+def get_telegram_request():
+    """
+    Obtain telegram request shared by all Telegram bots of the process. MICROBOT_PROXY settings are applied to it.
+    """
+    global _telegram_request
+    with _lock:
+        _reset_if_forked()
+        if _telegram_request is None:
+            request_kwargs = {'con_pool_size': get_pool_settings()['pool_maxsize']}
+            request_kwargs.update(getattr(settings, 'MICROBOT_PROXY', {}))
+            _telegram_request = TelegramRequest(**request_kwargs)
+        return _telegram_request
+
+
+def provider_error(error, response):
+    """
+    Keep the status code of the response in the error raised by a provider client. Send errors of 429 and 5xx
+    responses are transient.
+    """
+    error.status_code = response.status_code
+    return error
+
+
+class KikClient(KikApi):
+    """
+    Kik api client performing its calls with the shared session. The library calls the ``requests`` module for each
+    one opening a new connection.
+    """
+
+    def _post(self, path, data):
+        response = get_session().post(KIK_ROOT_URL.format(path),
+                                      auth=(self.bot, self.api_key),
+                                      timeout=60,
+                                      headers={'Content-Type': 'application/json'},
+                                      data=json.dumps(data))
+        if response.status_code != 200:
+            raise provider_error(KikError(response.text), response)
+        return response.json()
+
+    def send_messages(self, messages):
+        return self._post('/v1/message', {'messages': [message.to_json() for message in messages]})
+
+    def send_broadcast(self, messages):
+        return self._post('/v1/broadcast', {'messages': [message.to_json() for message in messages]})
+
+    def set_configuration(self, config):
+        return Configuration.from_json(self._post('/v1/config', config.to_json()))
+
+
+class MessengerBotClient(MessengerClient):
+    """
+    Messenger api client performing its calls with the shared session.
+    """
+
+    def send(self, message):
+        response = get_session().post('%s/messages' % self.GRAPH_API_URL,
+                                      params={'access_token': self.access_token},
+                                      json=message.to_dict())
+        if response.status_code != 200:
+            try:
+                MessengerError(**response.json()['error']).raise_exception()
+            except (ValueError, KeyError):
+                # Gateway errors have no json body
+                raise provider_error(MessengerException(response.text), response)
+            except MessengerException as e:
+                raise provider_error(e, response)
+        return response.json()
+
+    def subscribe_app(self):
+        response = get_session().post('%s/subscribed_apps' % self.GRAPH_API_URL,
+                                      params={'access_token': self.access_token})
+        return response.status_code == 200
@@ -0,0 +1,105 @@
+# -*- coding: utf-8 -*-
+from django.conf import settings
+from collections import OrderedDict
+import base64
+import json
+import sys
+import zlib
+import logging
+try:
+    from collections.abc import Mapping
+except ImportError:
+    from collections import Mapping  # noqa
+
+logger = logging.getLogger(__name__)
+
+#  Chat states keep the context of each previous state serialized to json. Bots can limit the states kept,
+#  their size and the response data fields stored so contexts do not grow while chats age.
+
+COMPRESSED = 'z:'
+#  Oldest states are removed first. Dicts keep insertion order since python 3.7
+ORDERED_DICT = sys.version_info >= (3, 7)
+
+
+def is_compressed():
+    return getattr(settings, 'MICROBOT_CHAT_CONTEXT_COMPRESSION', False)
+
+def dumps(value):
+    """
+    Serialize context to compact json. With MICROBOT_CHAT_CONTEXT_COMPRESSION it is compressed when shorter.
+    """
+    data = json.dumps(value, separators=(',', ':'))
+    if is_compressed():
+        compressed = COMPRESSED + base64.b64encode(zlib.compress(data.encode('utf-8'))).decode('ascii')
+        if len(compressed) < len(data):
+            return compressed
+    return data
+
+def loads(data):
+    """
+    Deserialize context either compressed or not. Order of states is kept.
+    """
+    if not data:
+        return {} if ORDERED_DICT else OrderedDict()
+    if data.startswith(COMPRESSED):
+        data = zlib.decompress(base64.b64decode(data[len(COMPRESSED):])).decode('utf-8')
+    if ORDERED_DICT:
+        return json.loads(data)
+    return json.loads(data, object_pairs_hook=OrderedDict)
+
+def _filter_fields(data, fields):
+    if isinstance(data, dict):
+        return {key: value for key, value in data.items() if key in fields}
+    if isinstance(data, list):
+        return [_filter_fields(item, fields) for item in data]
+    return data
+
+def limit(bot, state_context, context_key, context):
+    """
+    Add context of a state to the previous ones applying limits of the bot. Oldest states are removed first.
+
+    :param bot: Bot with context_max_states, context_max_bytes and context_response_fields limits
+    :param state_context: Previous contexts by state obtained with :func:`loads`. Oldest first
+    :param context_key: Key to store context. i.e. name of the previous state
+    :param context: Context generated in the processing
+    :returns: Contexts by state
+    """
+    if bot.context_response_fields and 'data' in context.get('response', {}):
+        fields = set(field.strip() for field in bot.context_response_fields.split(','))
+        context = dict(context, response=dict(context['response'], data=_filter_fields(context['response']['data'], fields)))
+    state_context.pop(context_key, None)
+    state_context[context_key] = context
+    if bot.context_max_states:
+        while len(state_context) > bot.context_max_states:
+            del state_context[next(iter(state_context))]
+    if bot.context_max_bytes:
+        size = len(json.dumps(state_context, separators=(',', ':')))
+        while size > bot.context_max_bytes and len(state_context) > 1:
+            key = next(iter(state_context))
+            value = state_context.pop(key)
+            # key, value, quotes, colon and comma
+            size -= len(json.dumps(key)) + len(json.dumps(value, separators=(',', ':'))) + 2
+        if size > bot.context_max_bytes:
+            logger.warning("Context of state %s exceeds %d bytes" % (context_key, bot.context_max_bytes))
+    return state_context
+
+
+class LazyContext(Mapping):
+    """
+    Previous contexts of a chat state. Decoded only when a template uses them.
+    """
+
+    def __init__(self, chat_state):
+        self._chat_state = chat_state
+
+    def __getitem__(self, key):
+        return self._chat_state.ctx[key]
+
+    def __iter__(self):
+        return iter(self._chat_state.ctx)
+
+    def __len__(self):
+        return len(self._chat_state.ctx)
+
+    def __repr__(self):
+        return repr(self._chat_state.ctx)
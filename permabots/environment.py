@@ -0,0 +1,49 @@
+# -*- coding: utf-8 -*-
+import uuid
+import logging
+from django.core.cache import cache
+from permabots import caching
+try:
+    from types import MappingProxyType
+except ImportError:
+    MappingProxyType = dict  # noqa
+
+logger = logging.getLogger(__name__)
+
+#  Environment of each bot lives in process memory as a read only dict shared by handlers and hooks.
+#  A version shared through the cache lets every process know when its environment is outdated.
+_environments = {}
+
+
+def _version_key(bot):
+    return caching.generate_key(bot._meta.model, bot.pk, 'env_version')
+
+def _get_version(bot):
+    key = _version_key(bot)
+    version = cache.get(key)
+    if version is None:
+        cache.add(key, uuid.uuid4().hex)
+        version = cache.get(key)
+    return version
+
+def get_env(bot):
+    """
+    Obtain environment variables of the bot. They are only loaded again when they change.
+
+    :param bot: Bot :class:`Bot <permabots.models.bot.Bot>`
+    :returns: Read only dict of values by key
+    """
+    version = _get_version(bot)
+    environment = _environments.get(bot.pk)
+    if environment is None or version is None or environment[0] != version:
+        logger.debug("Loading environment for bot %s with version %s" % (bot, version))
+        env = {}
+        for env_var in caching.get_or_set_related(bot, 'env_vars'):
+            env.update(env_var.as_json())
+        environment = version, MappingProxyType(env)
+        _environments[bot.pk] = environment
+    return environment[1]
+
+def delete(bot):
+    _environments.pop(bot.pk, None)
+    cache.delete(_version_key(bot))
@@ -0,0 +1,124 @@
+# -*- coding: utf-8 -*-
+from django.core.cache import cache
+from django.conf import settings
+from rest_framework.status import is_success
+from permabots import upstreams
+import hashlib
+import json
+import re
+import time
+import logging
+
+logger = logging.getLogger(__name__)
+
+#  GET responses of handler requests with cache_timeout are kept in cache by rendered url, params and headers.
+#  Expired responses are still served while one worker revalidates them, and when a response is not cached only one
+#  worker requests it while the others wait for its result.
+
+DEFAULT_STALE = 60
+#  Seconds waiting for the response requested by other worker
+POLL_INTERVAL = 0.05
+
+_directive = re.compile(r'([\w-]+)(?:=\"?(\d+)\"?)?')
+_no_store = ('no-store', 'no-cache', 'private')
+
+
+def get_stale():
+    return getattr(settings, 'MICROBOT_REQUEST_CACHE_STALE', DEFAULT_STALE)
+
+def generate_key(url, params=None, headers=None):
+    value = json.dumps([url, sorted((params or {}).items()), sorted((headers or {}).items())])
+    return 'permabots.http.%s' % hashlib.sha1(value.encode('utf-8')).hexdigest()
+
+def _lock_key(key):
+    return '%s-lock' % key
+
+def _wait_timeout(timeout):
+    return sum(timeout) if isinstance(timeout, (tuple, list)) else timeout
+
+def get_freshness(response, cache_timeout):
+    """
+    Seconds the response is fresh and seconds it can be served stale while revalidated.
+    Cache-Control of the response is applied when present.
+
+    :returns: (fresh, stale) or None if response must not be cached
+    """
+    directives = dict((name.lower(), value) for name, value in _directive.findall(response.headers.get('Cache-Control', '')))
+    if any(directive in directives for directive in _no_store):
+        return None
+    fresh = cache_timeout
+    for directive in ('s-maxage', 'max-age'):
+        if directives.get(directive):
+            fresh = int(directives[directive])
+            break
+    stale = int(directives['stale-while-revalidate']) if directives.get('stale-while-revalidate') else get_stale()
+    if not fresh:
+        return None
+    return fresh, stale
+
+def fetch(url, cache_timeout, timeout=None, params=None, headers=None):
+    """
+    Perform GET request and cache the response when successful.
+    """
+    response = upstreams.request('GET', url, timeout=timeout, params=params, headers=headers)
+    if is_success(response.status_code):
+        freshness = get_freshness(response, cache_timeout)
+        if freshness:
+            fresh, stale = freshness
+            cache.set(generate_key(url, params, headers), {'response': response,
+                                                           'expires': time.time() + fresh}, fresh + stale)
+    return response
+
+def refresh(url, cache_timeout, timeout=None, params=None, headers=None):
+    """
+    Revalidate an expired response. Stale response is kept when request fails.
+    """
+    try:
+        fetch(url, cache_timeout, timeout, params, headers)
+    except upstreams.UpstreamError as e:
+        logger.warning("Response of %s not revalidated: %s" % (url, e))
+    finally:
+        cache.delete(_lock_key(generate_key(url, params, headers)))
+
+def _wait(key, timeout):
+    deadline = time.time() + timeout
+    while time.time() < deadline:
+        time.sleep(POLL_INTERVAL)
+        entry = cache.get(key)
+        if entry:
+            return entry
+        if not cache.get(_lock_key(key)):
+            return None
+    return None
+
+def request(url, cache_timeout, timeout=None, params=None, headers=None):
+    """
+    Perform GET request through the response cache.
+
+    Fresh responses are returned from cache. Stale ones are returned too while a task revalidates them.
+    Not cached responses are requested by one worker at a time. The others wait for it and perform the request
+    by themselves only if it is not cached before their timeout.
+
+    :param url: Rendered url
+    :param cache_timeout: Seconds response is fresh when it has no Cache-Control max-age
+    :param timeout: Request timeout. See :func:`permabots.upstreams.request`
+    :returns: `requests.Response <http://docs.python-requests.org/en/master/api/#requests.Response>` _.
+    """
+    key = generate_key(url, params, headers)
+    timeout = upstreams.get_timeout(timeout)
+    entry = cache.get(key)
+    if entry:
+        if entry['expires'] < time.time() and cache.add(_lock_key(key), True, _wait_timeout(timeout)):
+            from permabots.tasks import refresh_request_cache
+            refresh_request_cache.delay(url, cache_timeout, timeout, params, headers)
+        return entry['response']
+    locked = cache.add(_lock_key(key), True, _wait_timeout(timeout))
+    if not locked:
+        entry = _wait(key, _wait_timeout(timeout))
+        if entry:
+            return entry['response']
+    try:
+        return fetch(url, cache_timeout, timeout, params, headers)
+    finally:
+        if locked:
+            cache.delete(_lock_key(key))
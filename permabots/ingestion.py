@@ -0,0 +1,211 @@
+# -*- coding: utf-8 -*-
+from django.conf import settings
+from django.core.cache import cache
+from django.utils import timezone
+from permabots.models import TelegramUser, TelegramChat, TelegramMessage, TelegramUpdate, TelegramCallbackQuery, \
+    KikUser, KikChat, KikMessage, MessengerMessage
+from permabots import caching
+from datetime import datetime
+from collections import OrderedDict
+import logging
+
+logger = logging.getLogger(__name__)
+
+#  Helpers to store data received by webhooks.
+#  In ephemeral mode webhook views send the serialized payload to the tasks. Messages are built there
+#  without saving them because they are only used once. Users and chats are still saved as chat states refer to them.
+
+
+def is_ephemeral():
+    return getattr(settings, 'MICROBOT_EPHEMERAL_MESSAGES', False)
+
+def upsert(model, items):
+    """
+    Obtain objects received in a webhook creating them if they do not exist yet and updating changed fields.
+
+    Objects are looked up in cache with one request. Missing ones are loaded from database with one query,
+    new ones are inserted with one query and changed ones updated with another. Cache is filled with all of them at once.
+
+    :param model: Model with provider ids as primary key. i.e. :class:`User <permabots.models.telegram_api.User>`
+    :param items: dict of field values by primary key
+    :returns: dict of objects by primary key
+    """
+    if not items:
+        return {}
+    keys = {caching.generate_key(model, pk): pk for pk in items}
+    objs = {keys[key]: obj for key, obj in cache.get_many(list(keys)).items()}
+    missing = [pk for pk in items if pk not in objs]
+    if missing:
+        objs.update(model.objects.in_bulk(missing))
+    new = [model(**items[pk]) for pk in missing if pk not in objs]
+    if new:
+        model.objects.bulk_create(new, ignore_conflicts=True)
+        objs.update((obj.pk, obj) for obj in new)
+    changed = []
+    for pk, fields in items.items():
+        obj = objs[pk]
+        if any(getattr(obj, field) != value for field, value in fields.items()):
+            for field, value in fields.items():
+                setattr(obj, field, value)
+            changed.append(obj)
+    if changed:
+        fields = set(field for item in items.values() for field in item)
+        fields.discard(model._meta.pk.name)
+        model.objects.bulk_update(changed, list(fields))
+    to_cache = set(missing).union(obj.pk for obj in changed)
+    if to_cache:
+        cache.set_many({caching.generate_key(model, pk): objs[pk] for pk in to_cache})
+    return objs
+
+def save_messages(model, messages, key, **lookups):
+    """
+    Insert the messages of a webhook not saved yet with one query. Providers redeliver batches not acknowledged,
+    so saved messages are looked up with one query and reused instead of being inserted again.
+
+    :param model: Message model. i.e. :class:`KikMessage <permabots.models.kik_api.KikMessage>`
+    :param messages: list of not saved messages
+    :param key: function returning the provider identity of a message. i.e. its provider id
+    :param lookups: filters matching the saved messages of the batch
+    :returns: list of saved messages in the same order
+    """
+    saved = {key(message): message for message in model.objects.filter(**lookups)}
+    new = []
+    for message in messages:
+        if key(message) not in saved:
+            saved[key(message)] = message
+            new.append(message)
+    if new:
+        model.objects.bulk_create(new)
+    return [saved[key(message)] for message in messages]
+
+def database_datetime(value):
+    """
+    Datetime as loaded from database. Naive datetimes built from provider timestamps are aware once saved with USE_TZ
+    """
+    if settings.USE_TZ and timezone.is_naive(value):
+        return timezone.make_aware(value)
+    return value
+
+def _telegram_messages(data):
+    if 'message' in data:
+        yield data['message']
+    elif 'callback_query' in data and 'message' in data['callback_query']:
+        yield data['callback_query']['message']
+
+def upsert_telegram_users_and_chats(data):
+    """
+    Create or update every user and chat referenced by a Telegram update.
+
+    :param data: Update serialized with :class:`UpdateSerializer <permabots.serializers.telegram_api.UpdateSerializer>`
+    :returns: dicts of users and chats by id
+    """
+    users, chats = {}, {}
+    for message in _telegram_messages(data):
+        users[message['from']['id']] = message['from']
+        chats[message['chat']['id']] = message['chat']
+    if 'callback_query' in data:
+        users[data['callback_query']['from']['id']] = data['callback_query']['from']
+    return upsert(TelegramUser, users), upsert(TelegramChat, chats)
+
+def build_telegram_message(data, users, chats):
+    return TelegramMessage(message_id=data['message_id'],
+                           from_user=users[data['from']['id']],
+                           date=datetime.fromtimestamp(data['date']),
+                           chat=chats[data['chat']['id']],
+                           text=data.get('text'))
+
+def build_telegram_update(data, bot):
+    """
+    Build a not saved Telegram update from serialized data.
+
+    :param data: Update serialized with :class:`UpdateSerializer <permabots.serializers.telegram_api.UpdateSerializer>`
+    :param bot: Telegram bot receiving the update
+    :returns: :class:`Update <permabots.models.telegram_api.Update>`
+    """
+    users, chats = upsert_telegram_users_and_chats(data)
+    if 'message' in data:
+        return TelegramUpdate(bot=bot,
+                              update_id=data['update_id'],
+                              message=build_telegram_message(data['message'], users, chats))
+    # Message may be not present if it is very old
+    if 'message' in data['callback_query']:
+        message = build_telegram_message(data['callback_query']['message'], users, chats)
+    else:
+        message = None
+    callback_query = TelegramCallbackQuery(callback_id=data['callback_query']['id'],
+                                           from_user=users[data['callback_query']['from']['id']],
+                                           message=message,
+                                           data=data['callback_query']['data'])
+    return TelegramUpdate(bot=bot,
+                          update_id=data['update_id'],
+                          callback_query=callback_query)
+
+def get_kik_chat(data, users):
+    try:
+        return caching.get_or_set(KikChat, data['chatId'])
+    except KikChat.DoesNotExist:
+        chat, _ = KikChat.objects.get_or_create(id=data['chatId'])
+        for participant in data.get('participants', []):
+            chat.participants.add(users[participant])
+        return chat
+
+def build_kik_messages(messages):
+    """
+    Build not saved Kik messages from serialized data. Senders and participants are created in bulk.
+
+    :param messages: list of messages serialized with :class:`KikMessageSerializer <permabots.serializers.kik_api.KikMessageSerializer>`
+    :returns: list of :class:`KikMessage <permabots.models.kik_api.KikMessage>`
+    """
+    usernames = set()
+    for data in messages:
+        usernames.add(data['from'])
+        usernames.update(data.get('participants', []))
+    users = upsert(KikUser, {username: {'username': username} for username in usernames})
+    chats = {}
+    built = []
+    for data in messages:
+        if data['chatId'] not in chats:
+            chats[data['chatId']] = get_kik_chat(data, users)
+        if data['type'] in ('start-chatting', 'scan-data'):
+            body = "/start"
+        else:
+            body = data['body']
+        built.append(KikMessage(message_id=data['id'],
+                                from_user=users[data['from']],
+                                timestamp=datetime.fromtimestamp(data['timestamp']),
+                                chat=chats[data['chatId']],
+                                body=body))
+    return built
+
+def build_messenger_message(data, bot):
+    """
+    Build a not saved Messenger message from serialized data.
+
+    :param data: Messaging item serialized by the Messenger webhook view
+    :param bot: Messenger bot receiving the message
+    :returns: :class:`MessengerMessage <permabots.models.messenger_api.MessengerMessage>`
+    """
+    if 'message' in data:
+        type, text, postback = MessengerMessage.MESSAGE, data['message'].get('text'), None
+    else:
+        type, text, postback = MessengerMessage.POSTBACK, None, data['postback'].get('payload')
+    return MessengerMessage(bot=bot,
+                            sender=data['sender']['id'],
+                            recipient=data['recipient']['id'],
+                            timestamp=datetime.fromtimestamp(data['timestamp']),
+                            type=type,
+                            text=text,
+                            postback=postback)
+
+def split_by(messages, key):
+    """
+    Split messages keeping their order. i.e. by chat
+
+    :param messages: list of messages
+    :param key: function returning the value messages are split by
+    :returns: list of lists of messages. One for each value
+    """
+    parts = OrderedDict()
+    for message in messages:
+        parts.setdefault(key(message), []).append(message)
+    return list(parts.values())
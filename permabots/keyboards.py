@@ -0,0 +1,69 @@
+# -*- coding: utf-8 -*-
+from django.conf import settings
+from collections import OrderedDict
+import ast
+import json
+import re
+import threading
+import logging
+
+logger = logging.getLogger(__name__)
+
+#  Keyboards built for each integration live in process memory. Built keyboards are not modified when
+#  messages are sent so the same one is shared by every message.
+_keyboards = OrderedDict()
+_lock = threading.Lock()
+#  Lists of quoted texts without escapes or quotes inside. i.e. [['menu', 'help']]
+_flat_list = re.compile(r"""^(?:[\s\[\],]|'[^'"\\]*'|"[^'"\\]*")*$""")
+
+
+def traverse(o, tree_types=list):
+    if isinstance(o, tree_types):
+        for value in o:
+            for subvalue in traverse(value, tree_types):
+                yield subvalue
+    else:
+        yield o
+
+def parse(keyboard):
+    """
+    Parse keyboard rendered from a response template. Lists of texts are parsed as json,
+    other keyboards, i.e. with (text, url) buttons, with ast.literal_eval.
+
+    :param keyboard: Python literal with lists of buttons
+    :returns: list of buttons
+    """
+    if _flat_list.match(keyboard):
+        try:
+            return list(traverse(json.loads(keyboard.replace("'", '"'))))
+        except ValueError:
+            # i.e. trailing commas
+            pass
+    return list(traverse(ast.literal_eval(keyboard)))
+
+
+def get_or_build(bot_service, keyboard):
+    """
+    Obtain keyboard built by the integration from process cache. Least recently used keyboards are discarded
+    when MICROBOT_KEYBOARD_CACHE_SIZE is reached.
+
+    :param bot_service: Service integration building the keyboard
+    :param keyboard: Keyboard rendered from a response template
+    :returns: Keyboard for the integration
+    """
+    key = (bot_service.identity, keyboard)
+    with _lock:
+        if key in _keyboards:
+            built_keyboard = _keyboards.pop(key)
+            _keyboards[key] = built_keyboard
+            return built_keyboard
+    built_keyboard = bot_service.build_keyboard(keyboard)
+    with _lock:
+        _keyboards[key] = built_keyboard
+        while len(_keyboards) > getattr(settings, 'MICROBOT_KEYBOARD_CACHE_SIZE', 1000):
+            _keyboards.popitem(last=False)
+    return built_keyboard
+
+def clear():
+    with _lock:
+        _keyboards.clear()
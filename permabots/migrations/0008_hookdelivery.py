@@ -0,0 +1,32 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from django.db import migrations, models
+import django.db.models.deletion
+import uuid
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('permabots', '0007_auto_20160530_0455'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='HookDelivery',
+            fields=[
+                ('id', models.UUIDField(default=uuid.uuid4, editable=False, primary_key=True, serialize=False)),
+                ('created_at', models.DateTimeField(auto_now_add=True, verbose_name='Date created')),
+                ('updated_at', models.DateTimeField(auto_now=True, verbose_name='Date updated')),
+                ('service', models.CharField(db_index=True, help_text='Service integration used. i.e. telegram', max_length=50, verbose_name='Service')),
+                ('chat_id', models.CharField(db_index=True, help_text='Chat identifier of the recipient', max_length=150, verbose_name='Chat Id')),
+                ('success', models.BooleanField(default=True, help_text='Response was sent to the recipient', verbose_name='Success')),
+                ('hook', models.ForeignKey(help_text='Hook delivered', on_delete=django.db.models.deletion.CASCADE, related_name='deliveries', to='permabots.Hook', verbose_name='Hook')),
+            ],
+            options={
+                'verbose_name': 'Hook Delivery',
+                'verbose_name_plural': 'Hook Deliveries',
+            },
+        ),
+    ]
@@ -0,0 +1,29 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('permabots', '0008_hookdelivery'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='kikchatstate',
+            name='version',
+            field=models.PositiveIntegerField(default=0, help_text='Number of updates. Used to detect concurrent updates', verbose_name='Version'),
+        ),
+        migrations.AddField(
+            model_name='messengerchatstate',
+            name='version',
+            field=models.PositiveIntegerField(default=0, help_text='Number of updates. Used to detect concurrent updates', verbose_name='Version'),
+        ),
+        migrations.AddField(
+            model_name='telegramchatstate',
+            name='version',
+            field=models.PositiveIntegerField(default=0, help_text='Number of updates. Used to detect concurrent updates', verbose_name='Version'),
+        ),
+    ]
@@ -0,0 +1,29 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('permabots', '0009_chatstate_version'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='bot',
+            name='context_max_bytes',
+            field=models.PositiveIntegerField(blank=True, help_text='Size of serialized context kept for each chat. Oldest states are removed first. Unlimited if not set', null=True, verbose_name='Context max bytes'),
+        ),
+        migrations.AddField(
+            model_name='bot',
+            name='context_max_states',
+            field=models.PositiveIntegerField(blank=True, help_text='Number of previous states whose context is kept for each chat. All if not set', null=True, verbose_name='Context max states'),
+        ),
+        migrations.AddField(
+            model_name='bot',
+            name='context_response_fields',
+            field=models.CharField(blank=True, default='', help_text='Comma separated fields of response data kept in context. All if not set', max_length=255, verbose_name='Context response fields'),
+        ),
+    ]
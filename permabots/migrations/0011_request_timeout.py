@@ -0,0 +1,24 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('permabots', '0010_bot_context_limits'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='bot',
+            name='request_timeout',
+            field=models.FloatField(blank=True, help_text='Seconds handler requests wait for the response. MICROBOT_REQUEST_TIMEOUT if not set', null=True, verbose_name='Request timeout'),
+        ),
+        migrations.AddField(
+            model_name='request',
+            name='timeout',
+            field=models.FloatField(blank=True, help_text='Seconds to wait for the response. Timeout of the bot if not set', null=True, verbose_name='Timeout'),
+        ),
+    ]
@@ -0,0 +1,19 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('permabots', '0011_request_timeout'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='request',
+            name='cache_timeout',
+            field=models.PositiveIntegerField(blank=True, help_text='Seconds Get responses are cached unless they set Cache-Control. Not cached if not set', null=True, verbose_name='Cache timeout'),
+        ),
+    ]
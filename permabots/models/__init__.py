@@ -10,4 +10,4 @@ from permabots.models.bot import Bot, TelegramBot, KikBot, MessengerBot  # NOQA
 from permabots.models.response import Response  # NOQA
 from permabots.models.handler import Handler, Request, UrlParam, HeaderParam  # NOQA
 from permabots.models.environment_vars import EnvironmentVar  # NOQA
-from permabots.models.hook import Hook, TelegramRecipient, KikRecipient, MessengerRecipient  # NOQA
+from permabots.models.hook import Hook, TelegramRecipient, KikRecipient, MessengerRecipient, HookDelivery  # NOQA
@@ -3,26 +3,29 @@ from django.db import models
 from django.utils.encoding import python_2_unicode_compatible
 from django.utils.translation import ugettext_lazy as _
 from telegram import Bot as TelegramBotAPI
-from kik import KikApi
 import logging
 from permabots.models.base import PermabotsModel
 from permabots.models import TelegramUser, TelegramChatState, KikChatState, MessengerChatState
-from django.urls import URLResolver
-from django.urls.resolvers import RegexPattern
-from django.urls import Resolver404
 from telegram import ParseMode, ReplyKeyboardRemove, InlineKeyboardButton, InlineKeyboardMarkup
 from telegram.bot import InvalidToken
-from telegram.utils.request import Request
-import ast
+from telegram.error import RetryAfter, NetworkError, BadRequest
 from django.conf import settings
 from permabots import validators
 from kik.messages.responses import TextResponse
 from kik.messages.text import TextMessage
 from kik.messages.keyboards import SuggestedResponseKeyboard
 from kik.configuration import Configuration
-from messengerbot import MessengerClient, messages
+from messengerbot import messages
 import sys
-from permabots import caching
+import requests
+from permabots import routing
+from permabots import scheduling
+from permabots import throttling
+from permabots import connections
+from permabots import clients
+from permabots import chat_states
+from permabots import contexts
+from permabots import keyboards
 from messengerbot.attachments import TemplateAttachment
 from messengerbot.elements import Element, PostbackButton, WebUrlButton
 from messengerbot.templates import GenericTemplate
@@ -30,14 +33,6 @@ import textwrap
 
 logger = logging.getLogger(__name__)
 
-def traverse(o, tree_types=list):
-    if isinstance(o, tree_types):
-        for value in o:
-            for subvalue in traverse(value, tree_types):
-                yield subvalue
-    else:
-        yield o
-
 
 @python_2_unicode_compatible
 class Bot(PermabotsModel):
@@ -57,6 +52,14 @@ class Bot(PermabotsModel):
     messenger_bot = models.OneToOneField('MessengerBot', verbose_name=_("Messenger Bot"), related_name='bot',
                                          on_delete=models.SET_NULL, blank=True, null=True,
                                          help_text=_("Messenger Bot"))
+    context_max_states = models.PositiveIntegerField(_('Context max states'), null=True, blank=True,
+                                                     help_text=_("Number of previous states whose context is kept for each chat. All if not set"))
+    context_max_bytes = models.PositiveIntegerField(_('Context max bytes'), null=True, blank=True,
+                                                    help_text=_("Size of serialized context kept for each chat. Oldest states are removed first. Unlimited if not set"))
+    context_response_fields = models.CharField(_('Context response fields'), max_length=255, blank=True, default='',
+                                               help_text=_("Comma separated fields of response data kept in context. All if not set"))
+    request_timeout = models.FloatField(_('Request timeout'), null=True, blank=True,
+                                        help_text=_("Seconds handler requests wait for the response. MICROBOT_REQUEST_TIMEOUT if not set"))
     
     class Meta:
         verbose_name = _('Bot')
@@ -66,83 +69,147 @@ class Bot(PermabotsModel):
         return '%s' % self.name
     
     def update_chat_state(self, bot_service, message, chat_state, target_state, context):
+        """
+        Move the chat to the target state of the handler.
+        
+        :returns: False if the transition was dropped because the chat left the source state concurrently
+        """
         context_target_state = chat_state.state.name.lower().replace(" ", "_") if chat_state else '_start'
         if not chat_state:
                 logger.warning("Chat/sender state for update chat %s not exists" % 
                                (bot_service.get_chat_id(message)))
-                bot_service.create_chat_state(message, target_state, {context_target_state: context})
+                bot_service.create_chat_state(message, target_state, contexts.limit(self, contexts.loads(None),
+                                                                                    context_target_state, context))
         else:
             if chat_state.state != target_state:                
-                state_context = chat_state.ctx
-                state_context[context_target_state] = context
-                chat_state.ctx = state_context
-                chat_state.state = target_state
-                chat_state.save()
+                if not chat_state.compare_and_set(target_state, context_target_state, context, self):
+                    chat_states.delete(chat_state)
+                    return False
+                chat_states.set(chat_state)
                 logger.debug("Chat state updated:%s for message %s with (%s,%s)" % 
                              (target_state, message, chat_state.state, context))
             else:
                 logger.debug("ChateState stays in %s" % target_state)
+        return True
     
-    def handle_message(self, message, bot_service):
+    def handle_message(self, message, bot_service, outbox=None):
         """
         Process incoming message generating a response to the sender.
         
+        Response is sent directly or by a delivery task when MICROBOT_DELIVERY_QUEUE is set. When it can not be sent
+        directly the rest of it is sent again by a delivery task. It is not sent when the chat leaves the state the handler
+        was resolved for while the message is handled.
+        
         :param message: Generic message received from provider
         :param bot_service: Service Integration
         :type bot_service: IntegrationBot :class:`IntegrationBot <permabots.models.bot.IntegrationBot>`
+        :param outbox: list where responses to deliver are appended instead of delivering each one in its own task.
+            i.e. to deliver responses of a chat together. See :func:`permabots.tasks.deliver_responses`
 
         .. note:: Message content will be extracted by IntegrationBot
         """
-        urlpatterns = []
-        state_context = {}
         chat_state = bot_service.get_chat_state(message)
-        for handler in caching.get_or_set_related(self, 'handlers', 'response', 'request', 'target_state'):
-            if handler.enabled:
-                source_states = caching.get_or_set_related(handler, 'source_states')
-                if chat_state:
-                    state_context = chat_state.ctx
-                if not source_states or (chat_state and chat_state.state in source_states):
-                        urlpatterns.append(handler.urlpattern())
-
-        resolver = URLResolver(RegexPattern(r'^'), urlpatterns)
-        try:
-            resolver_match = resolver.resolve(bot_service.message_text(message))
-        except Resolver404:
+        router = routing.get_router(self)
+        resolved = router.resolve(bot_service.message_text(message), chat_state.state_id if chat_state else None)
+        if resolved is None:
             logger.warning("Handler not found for %s" % message)
         else:
-            callback, callback_args, callback_kwargs = resolver_match
-            logger.debug("Calling callback:%s for message %s with %s" % 
-                         (callback, message, callback_kwargs))
-            text, keyboard, target_state, context = callback(self, message=message, service=bot_service.identity, 
-                                                             state_context=state_context, **callback_kwargs)
-            if target_state:
-                self.update_chat_state(bot_service, message, chat_state, target_state, context)
-            keyboard = bot_service.build_keyboard(keyboard)
-            bot_service.send_message(bot_service.get_chat_id(message), text, keyboard, message)
+            handler, pattern_context = resolved
+            state_context = contexts.LazyContext(chat_state) if chat_state else {}
+            logger.debug("Calling handler:%s for message %s with %s" % 
+                         (handler, message, pattern_context))
+            text, keyboard, target_state, context = handler.process(self, message=message, service=bot_service.identity, 
+                                                                    state_context=state_context, **pattern_context)
+            chat_id = bot_service.get_chat_id(message)
+            if target_state and not self.update_chat_state(bot_service, message, chat_state, target_state, context):
+                # Response was generated for a state the chat is not in anymore
+                logger.warning("Response to %s for bot %s not sent. Chat state changed while handling %s" % (chat_id, bot_service, message))
+                return
+            from permabots.tasks import deliver_responses
+            if scheduling.get_delivery_queue():
+                response = (chat_id, text, keyboard, bot_service.get_reply_options(message))
+                if outbox is None:
+                    deliver_responses(bot_service, [response])
+                else:
+                    outbox.append(response)
+            else:
+                try:
+                    bot_service.send_message(chat_id, text, keyboards.get_or_build(bot_service, keyboard), message)
+                except throttling.SendError as e:
+                    retry = throttling.get_retry(e, 0)
+                    if retry is None:
+                        logger.error("Response to %s for bot %s not sent: %s" % (chat_id, bot_service, e))
+                    else:
+                        failures, countdown = retry
+                        deliver_responses(bot_service, [(chat_id, text, keyboard, bot_service.get_reply_options(message))],
+                                          e.sent, failures, countdown)
+            
+    def integrations(self):
+        """
+        :returns: list of enabled service integrations
+        """
+        return [bot_service for bot_service in (self.telegram_bot, self.kik_bot, self.messenger_bot) if bot_service and bot_service.enabled]
+    
+    def integration(self, identity):
+        for bot_service in self.integrations():
+            if bot_service.identity == identity:
+                return bot_service
+        return None
             
     def handle_hook(self, hook, data):
         """
         Process notification hook.
         
+        Response is generated once. Recipients of each enabled integration are split in chunks of MICROBOT_HOOK_CHUNK_SIZE
+        and each chunk is delivered in its own task.
+        
         :param hook: Notification hook to process
         :type hook: Hook :class:`Hook <permabots.models.hook.Hook>`
         :param data: JSON data from webhook POST
         
         """
+        from permabots.tasks import handle_hook_recipients
         logger.debug("Calling hook %s process: with %s" % (hook.key, data))
         text, keyboard = hook.process(self, data)
-        if hook.bot.telegram_bot and hook.bot.telegram_bot.enabled:
-            telegram_keyboard = hook.bot.telegram_bot.build_keyboard(keyboard)
-            for recipient in hook.telegram_recipients.all():
-                hook.bot.telegram_bot.send_message(recipient.chat_id, text, telegram_keyboard)
-        if hook.bot.kik_bot and hook.bot.kik_bot.enabled:
-            kik_keyboard = hook.bot.kik_bot.build_keyboard(keyboard)
-            for recipient in hook.kik_recipients.all():
-                hook.bot.kik_bot.send_message(recipient.chat_id, text, kik_keyboard, user=recipient.username)
-        if hook.bot.messenger_bot and hook.bot.messenger_bot.enabled:
-            messenger_keyboard = hook.bot.messenger_bot.build_keyboard(keyboard)
-            for recipient in hook.messenger_recipients.all():
-                hook.bot.messenger_bot.send_message(recipient.chat_id, text, messenger_keyboard)
+        chunk_size = getattr(settings, 'MICROBOT_HOOK_CHUNK_SIZE', 100)
+        for bot_service in self.integrations():
+            recipient_ids = list(hook.recipients(bot_service.identity).values_list('id', flat=True))
+            for chunk, last in bot_service.batch(recipient_ids, chunk_size):
+                handle_hook_recipients.apply_async((hook.id, bot_service.identity, chunk, text, keyboard),
+                                                   **scheduling.delivery_options())
+                
+    def handle_hook_recipients(self, hook, identity, recipient_ids, text, keyboard, first=0):
+        """
+        Deliver a notification hook response to a chunk of recipients of one integration, recording
+        a :class:`HookDelivery <permabots.models.hook.HookDelivery>` for each recipient.
+        
+        :param hook: Notification hook processed
+        :type hook: Hook :class:`Hook <permabots.models.hook.Hook>`
+        :param identity: Service integration identity
+        :param recipient_ids: Identifiers of the recipients in the order they are sent
+        :param text: Text response
+        :param keyboard: Keyboard response
+        :param first: Message of the response to send first to the first recipient
+        :raises Throttled: when recipients can not be sent yet. Deliveries already sent are recorded and 
+            recipient_ids of the error are the ones to send again
+        """
+        bot_service = self.integration(identity)
+        if not bot_service:
+            logger.warning("Hook %s not delivered by disabled %s integration" % (hook.key, identity))
+            return
+        built_keyboard = keyboards.get_or_build(bot_service, keyboard)
+        recipients = dict((str(recipient.id), recipient) for recipient in hook.recipients(identity).filter(id__in=recipient_ids))
+        # Ids are strings once serialized by the broker
+        recipient_ids = [str(recipient_id) for recipient_id in recipient_ids if str(recipient_id) in recipients]
+        try:
+            results = bot_service.send_bulk_message([(recipients[recipient_id].chat_id,
+                                                      getattr(recipients[recipient_id], 'username', None))
+                                                     for recipient_id in recipient_ids], text, built_keyboard, first)
+        except throttling.Throttled as e:
+            hook.add_deliveries(identity, e.results)
+            e.recipient_ids = recipient_ids[len(e.results):]
+            raise
+        hook.add_deliveries(identity, results)
             
 class IntegrationBot(PermabotsModel): 
     """
@@ -155,6 +222,22 @@ class IntegrationBot(PermabotsModel):
         verbose_name_plural = _('Integration Bots')
         abstract = True
         
+    def __getstate__(self):
+        state = super(IntegrationBot, self).__getstate__().copy()
+        #  Api client is not pickled. It is obtained again from the clients of the process
+        state['_bot'] = None
+        return state
+    
+    def __setstate__(self, state):
+        super(IntegrationBot, self).__setstate__(state)
+        self.load_bot()
+        
+    def load_bot(self):
+        """
+        Implement this method to initialize the bot only when its credentials are valid. Used when it is created or unpickled
+        """
+        raise NotImplementedError
+        
     def init_bot(self):
         """
         Implement this method to perform some specific intialization to the bot
@@ -245,7 +328,7 @@ class IntegrationBot(PermabotsModel):
         """
         raise NotImplementedError
         
-    def send_message(self, chat_id, text, keyboard, reply_message=None, user=None):
+    def send_message(self, chat_id, text, keyboard, reply_message=None, user=None, first=0):
         """
         Send message with the a response generated.
         
@@ -254,11 +337,62 @@ class IntegrationBot(PermabotsModel):
         :param keyboard: Keyboard response
         :param reply_message: Message to reply
         :param user: When no replying in some providers is not enough with chat_id
+        :param first: Message of the response to send first. Previous ones were already sent
+        :raises SendError: when a message is not sent. Messages after it are not sent either so they keep their order
+        :raises Throttled: when a message can not be sent yet because of :mod:`throttling <permabots.throttling>`
         
         .. note:: Each provider has its own limits for texts and keyboards buttons. Implement here how to split a response to several messages.
         """
         raise NotImplementedError
     
+    def is_transient_error(self, error):
+        """
+        Whether sending a message again may succeed after the error. Connection errors, timeouts and 429 or 5xx
+        responses of the provider are transient. Messages failing with other errors, i.e. blocked users or wrong chat
+        ids, are not sent again.
+        
+        :param error: Exception raised by the provider client
+        """
+        if isinstance(error, (requests.ConnectionError, requests.Timeout)):
+            return True
+        status_code = getattr(error, 'status_code', None)
+        return status_code is not None and (status_code == 429 or status_code >= 500)
+    
+    def get_reply_options(self, message):
+        """
+        Options of send_message to reply a message without the message itself. i.e. when responses are delivered by other task.
+        
+        :param message: Message from provider
+        :returns: dict of serializable send_message options
+        """
+        return {}
+    
+    def send_bulk_message(self, recipients, text, keyboard, first=0):
+        """
+        Send the same response to several recipients. By default each recipient is sent with send_message.
+        
+        :param recipients: list of (chat_id, user)
+        :param text: Text response
+        :param keyboard: Keyboard response
+        :param first: Message of the response to send first to the first recipient
+        :returns: list of (chat_id, success)
+        :raises Throttled: when a recipient can not be sent yet. Its results are the ones of the recipients sent before
+        
+        .. note:: Override it when the provider is able to send messages for several recipients in one request.
+        """
+        results = []
+        for index, (chat_id, user) in enumerate(recipients):
+            try:
+                self.send_message(chat_id, text, keyboard, user=user, first=first if index == 0 else 0)
+            except throttling.Throttled as e:
+                e.results = results
+                raise
+            except throttling.SendError:
+                results.append((chat_id, False))
+            else:
+                results.append((chat_id, True))
+        return results
+    
     def create_chat_state(self, message, target_state, context):
         """
         Crate specific chat state modelling for the integration. It is called only when first chat interaction is performed by a user.
@@ -296,23 +430,22 @@ class TelegramBot(IntegrationBot):
     
     def __init__(self, *args, **kwargs):
         super(TelegramBot, self).__init__(*args, **kwargs)
+        self.load_bot()
+            
+    def __str__(self):
+        return "%s" % (self.user_api.first_name or self.token if self.user_api else self.token)
+    
+    def load_bot(self):
         self._bot = None
         if self.token:
             try:
                 self.init_bot()
             except InvalidToken:
                 logger.warning("Incorrect token %s" % self.token)
-            
-    def __str__(self):
-        return "%s" % (self.user_api.first_name or self.token if self.user_api else self.token)
-    
+                
     def init_bot(self):
-        bot_kwargs = {}
-        if hasattr(settings, 'MICROBOT_PROXY'):
-            bot_kwargs = {
-                'request': Request(**settings.MICROBOT_PROXY)
-            }
-        self._bot = TelegramBotAPI(self.token, **bot_kwargs)
+        self._bot = clients.get_or_set(self, (self.token,),
+                                       lambda: TelegramBotAPI(self.token, request=connections.get_telegram_request()))
 
     @property
     def hook_id(self):
@@ -350,10 +483,7 @@ class TelegramBot(IntegrationBot):
     
     def get_chat_state(self, message):
         chat, user = self._get_chat_and_user(message)
-        try:
-            return TelegramChatState.objects.select_related('state', 'chat', 'user').get(chat=chat, user=user, state__bot=self.bot)
-        except TelegramChatState.DoesNotExist:
-            return None
+        return chat_states.get(TelegramChatState, self.bot, chat, user)
         
     def _create_keyboard_button(self, element):
         if isinstance(element, tuple):
@@ -367,7 +497,7 @@ class TelegramBot(IntegrationBot):
     def build_keyboard(self, keyboard):       
         built_keyboard = []
         if keyboard:
-            built_keyboard = InlineKeyboardMarkup([[self._create_keyboard_button(element)] for element in traverse(ast.literal_eval(keyboard))])
+            built_keyboard = InlineKeyboardMarkup([[self._create_keyboard_button(element)] for element in keyboards.parse(keyboard)])
         else:
             built_keyboard = ReplyKeyboardHide()
         return built_keyboard
@@ -383,10 +513,20 @@ class TelegramBot(IntegrationBot):
         chat, user = self._get_chat_and_user(message)
         return chat.id
     
-    def send_message(self, chat_id, text, keyboard, reply_message=None, user=None):
+    def get_reply_options(self, message):
+        if message.message:
+            return {'reply_to_message_id': message.message.message_id}
+        elif message.callback_query and message.callback_query.message:
+            return {'reply_to_message_id': message.callback_query.message.message_id}
+        return {}
+    
+    def is_transient_error(self, error):
+        # Timeouts and 5xx responses raise NetworkError. BadRequest is the NetworkError of 400 responses
+        return isinstance(error, NetworkError) and not isinstance(error, BadRequest)
+    
+    def send_message(self, chat_id, text, keyboard, reply_message=None, user=None, reply_to_message_id=None, first=0):
         parse_mode = ParseMode.HTML
         disable_web_page_preview = True
-        reply_to_message_id = None
         if reply_message:
             if reply_message.message:
                 reply_to_message_id = reply_message.message.message_id
@@ -399,8 +539,11 @@ class TelegramBot(IntegrationBot):
                 msgs.append((chunk, None))
         if keyboard:
             msgs[-1] = (msgs[-1][0], keyboard)
-        for msg in msgs:
+        chat_type = 'group' if str(chat_id).startswith('-') else 'private'
+        for index in range(first, len(msgs)):
+            msg = msgs[index]
             try:
+                throttling.throttle_chat(self, chat_id, chat_type)
                 logger.debug("Message to send:(chat:%s,text:%s,parse_mode:%s,disable_preview:%s,keyboard:%s, reply_to_message_id:%s" %
                              (chat_id, msg[0], parse_mode, disable_web_page_preview, msg[1], reply_to_message_id))
                 self._bot.send_message(chat_id=chat_id, text=msg[0], parse_mode=parse_mode, 
@@ -408,12 +551,21 @@ class TelegramBot(IntegrationBot):
                                        reply_to_message_id=reply_to_message_id)        
                 logger.debug("Message sent OK:(chat:%s,text:%s,parse_mode:%s,disable_preview:%s,reply_keyboard:%s, reply_to_message_id:%s" %
                              (chat_id, msg[0], parse_mode, disable_web_page_preview, msg[1], reply_to_message_id))
+            except throttling.Throttled as e:
+                e.sent = index
+                raise
+            except RetryAfter as e:
+                # Every worker stops sending messages of the bot and this chunk is sent again by a task
+                logger.warning("Flood limit sending to chat %s. Retry after %s seconds" % (chat_id, e.retry_after))
+                throttling.pause(self, e.retry_after)
+                raise throttling.Throttled(e.retry_after, index)
             except:
                 exctype, value = sys.exc_info()[:2] 
                 
                 logger.error("""Error trying to send message:(chat:%s,text:%s,parse_mode:%s,disable_preview:%s,
                              reply_keyboard:%s, reply_to_message_id:%s): %s:%s""" % 
                              (chat_id, msg[0], parse_mode, disable_web_page_preview, msg[1], reply_to_message_id, exctype, value))
+                raise throttling.SendError("%s:%s" % (exctype, value), index, self.is_transient_error(value))
                 
             
 @python_2_unicode_compatible
@@ -427,6 +579,8 @@ class KikBot(IntegrationBot):
     """
     api_key = models.CharField(_('Kik Bot API key'), max_length=200, db_index=True)
     username = models.CharField(_("Kik Bot User name"), max_length=200)
+    #  Kik limit of messages in each request
+    MAX_MESSAGES_PER_REQUEST = 25
    
     class Meta:
         verbose_name = _('Kik Bot')
@@ -434,9 +588,7 @@ class KikBot(IntegrationBot):
     
     def __init__(self, *args, **kwargs):
         super(KikBot, self).__init__(*args, **kwargs)
-        self._bot = None
-        if self.api_key and self.username:
-            self.init_bot()
+        self.load_bot()
            
     def __str__(self):
         return "%s" % self.username
@@ -444,8 +596,13 @@ class KikBot(IntegrationBot):
     def __repr__(self):
         return "(%s, %s)" % (self.username, self.api_key)
     
+    def load_bot(self):
+        self._bot = None
+        if self.api_key and self.username:
+            self.init_bot()
+    
     def init_bot(self):
-        self._bot = KikApi(self.username, self.api_key)
+        self._bot = clients.get_or_set(self, (self.username, self.api_key), lambda: connections.KikClient(self.username, self.api_key))
     
     def set_webhook(self, url):
         self._bot.set_configuration(Configuration(webhook=url))
@@ -470,10 +627,7 @@ class KikBot(IntegrationBot):
         return message.body
     
     def get_chat_state(self, message):
-        try:
-            return KikChatState.objects.select_related('state', 'chat', 'user').get(chat=message.chat, user=message.from_user, state__bot=self.bot)
-        except KikChatState.DoesNotExist:
-            return None
+        return chat_states.get(KikChatState, self.bot, message.chat, message.from_user)
         
     def _create_keyboard_button(self, element):
         # Extend Kik for Link buttons
@@ -485,7 +639,7 @@ class KikBot(IntegrationBot):
     def build_keyboard(self, keyboard):                
         built_keyboard = []
         if keyboard:
-            built_keyboard = [self._create_keyboard_button(element) for element in traverse(ast.literal_eval(keyboard))][:20]           
+            built_keyboard = [self._create_keyboard_button(element) for element in keyboards.parse(keyboard)][:20]           
         return built_keyboard
     
     def create_chat_state(self, message, target_state, context):
@@ -497,11 +651,7 @@ class KikBot(IntegrationBot):
     def get_chat_id(self, message):
         return message.chat.id
     
-    def send_message(self, chat_id, text, keyboard, reply_message=None, user=None):
-        if reply_message:
-            to = reply_message.from_user.username
-        if user:
-            to = user
+    def _build_messages(self, to, chat_id, text, keyboard):
         texts = text.strip().split('\\n')
         msgs = []
         for txt in texts:
@@ -510,6 +660,22 @@ class KikBot(IntegrationBot):
                 msgs.append(msg)
         if keyboard:
             msgs[-1].keyboards.append(SuggestedResponseKeyboard(to=to, responses=keyboard))
+        return msgs
+    
+    def get_reply_options(self, message):
+        return {'user': message.from_user.username}
+    
+    def send_message(self, chat_id, text, keyboard, reply_message=None, user=None, first=0):
+        if reply_message:
+            to = reply_message.from_user.username
+        if user:
+            to = user
+        msgs = self._build_messages(to, chat_id, text, keyboard)[first:]
+        try:
+            throttling.throttle(self, len(msgs))
+        except throttling.Throttled as e:
+            e.sent = first
+            raise
         try:
             logger.debug("Messages to send:(%s)" % str([m.to_json() for m in msgs]))
             self._bot.send_messages(msgs)    
@@ -517,6 +683,56 @@ class KikBot(IntegrationBot):
         except:
             exctype, value = sys.exc_info()[:2]
             logger.error("Error trying to send message:(%s): %s:%s" % (str([m.to_json() for m in msgs]), exctype, value))
+            raise throttling.SendError("%s:%s" % (exctype, value), first, self.is_transient_error(value))
+    
+    def send_bulk_message(self, recipients, text, keyboard, first=0):
+        """
+        Messages for several recipients are packed in requests of up to MAX_MESSAGES_PER_REQUEST messages.
+        When a request fails it is split to isolate failing recipients.
+        """
+        batches = []
+        batch = []
+        batch_size = 0
+        for index, (chat_id, user) in enumerate(recipients):
+            msgs = self._build_messages(user, chat_id, text, keyboard)[first if index == 0 else 0:]
+            if batch and batch_size + len(msgs) > self.MAX_MESSAGES_PER_REQUEST:
+                batches.append(batch)
+                batch = []
+                batch_size = 0
+            batch.append((chat_id, msgs))
+            batch_size += len(msgs)
+        if batch:
+            batches.append(batch)
+        results = []
+        try:
+            for batch in batches:
+                self._send_batch(batch, results)
+        except throttling.Throttled as e:
+            # first only applies while the first recipient is not sent
+            e.sent = 0 if results else first
+            e.results = results
+            raise
+        return results
+    
+    def _send_batch(self, batch, results):
+        msgs = [msg for chat_id, recipient_msgs in batch for msg in recipient_msgs]
+        throttling.throttle(self, len(msgs))
+        try:
+            logger.debug("Messages to send:(%s)" % str([m.to_json() for m in msgs]))
+            self._bot.send_messages(msgs)
+            logger.debug("Message sent OK:(%s)" % str([m.to_json() for m in msgs]))
+        except:
+            exctype, value = sys.exc_info()[:2]
+            if len(batch) == 1:
+                logger.error("Error trying to send message:(%s): %s:%s" % (str([m.to_json() for m in msgs]), exctype, value))
+                results.append((batch[0][0], False))
+                return
+            logger.warning("Error trying to send messages to %d recipients, splitting: %s:%s" % (len(batch), exctype, value))
+            middle = len(batch) // 2
+            self._send_batch(batch[:middle], results)
+            self._send_batch(batch[middle:], results)
+            return
+        results.extend((chat_id, True) for chat_id, recipient_msgs in batch)
             
 @python_2_unicode_compatible
 class MessengerBot(IntegrationBot):
@@ -538,10 +754,8 @@ class MessengerBot(IntegrationBot):
     
     def __init__(self, *args, **kwargs):
         super(MessengerBot, self).__init__(*args, **kwargs)
-        self._bot = None
         self.webhook = False
-        if self.token:
-            self.init_bot()
+        self.load_bot()
            
     def __str__(self):
         return "%s" % self.token
@@ -549,8 +763,13 @@ class MessengerBot(IntegrationBot):
     def __repr__(self):
         return "(%s, %s)" % (self.id, self.token)
     
+    def load_bot(self):
+        self._bot = None
+        if self.token:
+            self.init_bot()
+    
     def init_bot(self):
-        self._bot = MessengerClient(self.token)
+        self._bot = clients.get_or_set(self, (self.token,), lambda: connections.MessengerBotClient(self.token))
     
     def set_webhook(self, url):
         # Url is set in facebook dashboard. Just subscribe
@@ -577,10 +796,7 @@ class MessengerBot(IntegrationBot):
         return message.data
     
     def get_chat_state(self, message):
-        try:
-            return MessengerChatState.objects.select_related('state').get(chat=message.sender, state__bot=self.bot)
-        except MessengerChatState.DoesNotExist:
-            return None
+        return chat_states.get(MessengerChatState, self.bot, message.sender)
         
     def _create_keyboard_button(self, element):
         if isinstance(element, tuple):
@@ -595,7 +811,7 @@ class MessengerBot(IntegrationBot):
         built_keyboard = None
         if keyboard:
             # same payload as title
-            built_keyboard = [self._create_keyboard_button(element) for element in traverse(ast.literal_eval(keyboard))]
+            built_keyboard = [self._create_keyboard_button(element) for element in keyboards.parse(keyboard)]
         return built_keyboard
     
     def create_chat_state(self, message, target_state, context):
@@ -606,7 +822,7 @@ class MessengerBot(IntegrationBot):
     def get_chat_id(self, message):
         return message.sender
         
-    def send_message(self, chat_id, text, keyboard, reply_message=None, user=None):
+    def send_message(self, chat_id, text, keyboard, reply_message=None, user=None, first=0):
         texts = text.strip().split('\\n')
         msgs = []
         for txt in texts:             
@@ -627,12 +843,18 @@ class MessengerBot(IntegrationBot):
             attachment = TemplateAttachment(generic_template)
             msgs.append(messages.Message(attachment=attachment))
         
-        for msg in msgs:
+        for index in range(first, len(msgs)):
+            msg = msgs[index]
             try:
+                throttling.throttle(self)
                 logger.debug("Message to send:(%s)" % msg.to_dict())
                 recipient = messages.Recipient(recipient_id=chat_id)
                 self._bot.send(messages.MessageRequest(recipient, msg))
                 logger.debug("Message sent OK:(%s)" % msg.to_dict())
+            except throttling.Throttled as e:
+                e.sent = index
+                raise
             except:
                 exctype, value = sys.exc_info()[:2] 
                 logger.error("Error trying to send message:(%s): %s:%s" % (msg.to_dict(), exctype, value))
+                raise throttling.SendError("%s:%s" % (exctype, value), index, self.is_transient_error(value))
@@ -4,15 +4,15 @@ from django.utils.encoding import python_2_unicode_compatible
 from django.utils.translation import ugettext_lazy as _
 from permabots.models.base import PermabotsModel
 from permabots.models import Bot, Response
-from jinja2 import Environment
-import requests
-from django.conf.urls import url
 import json
 import logging
 from permabots import validators
 from rest_framework.status import is_success
-from permabots import caching 
 from permabots import utils
+from permabots import rendering
+from permabots import upstreams
+from permabots import http_caching
+from permabots import environment
 
 logger = logging.getLogger(__name__)
 
@@ -40,9 +40,7 @@ class AbstractParam(PermabotsModel):
         
         :param context: Processing context
         """
-        env = Environment(extensions=['jinja2_time.TimeExtension'])        
-        value_template = env.from_string(self.value_template)
-        return value_template.render(**context) 
+        return rendering.render(self.value_template, **context)
 
 @python_2_unicode_compatible
 class Request(PermabotsModel):
@@ -62,6 +60,10 @@ class Request(PermabotsModel):
     method = models.CharField(_("Method"), max_length=128, default=GET, choices=METHOD_CHOICES, help_text=_("Define Http method for the request"))
     data = models.TextField(null=True, blank=True, verbose_name=_("Data of the request"), help_text=_("Set POST/PUT/PATCH data in json format"),
                             validators=[validators.validate_template])
+    timeout = models.FloatField(_('Timeout'), null=True, blank=True,
+                                help_text=_("Seconds to wait for the response. Timeout of the bot if not set"))
+    cache_timeout = models.PositiveIntegerField(_('Cache timeout'), null=True, blank=True,
+                                                help_text=_("Seconds Get responses are cached unless they set Cache-Control. Not cached if not set"))
     
     class Meta:
         verbose_name = _('Request')
@@ -71,58 +73,77 @@ class Request(PermabotsModel):
         return "%s(%s)" % (self.method, self.url_template)
     
     def _get_method(self):
-        method = {self.GET: requests.get,
-                  self.POST: requests.post,
-                  self.PUT: requests.put,
-                  self.PATCH: requests.patch,
-                  self.DELETE: requests.delete}
-        try:
-            return method[self.method]
-        except KeyError:
+        if self.method not in (self.GET, self.POST, self.PUT, self.PATCH, self.DELETE):
             logger.error("Method %s not valid" % self.method)
-            return method[self.GET]
+            return self.GET.upper()
+        return self.method.upper()
     
-    def _url_params(self, **context):
-        params = {}
-        for param in self.url_parameters.all():
-            params[param.key] = param.process(**context)
+    def __getstate__(self):
+        # Compiled templates are not pickled when handlers are cached
+        state = dict(super(Request, self).__getstate__())
+        state.pop('_params_snapshot', None)
+        return state
+    
+    def _params(self):
+        """
+        Url and header parameters with their templates compiled and the variables they use. Taken once from parameters
+        prefetched with the handlers of the bot, the router is rebuilt when they change.
+        """
+        params = self.__dict__.get('_params_snapshot')
+        if params is None:
+            url_params = list(self.url_parameters.all())
+            header_params = list(self.header_parameters.all())
+            params = ([(param.key, rendering.get_template(param.value_template)) for param in url_params],
+                      [(header.key, rendering.get_template(header.value_template)) for header in header_params],
+                      rendering.get_variables(*[param.value_template for param in url_params + header_params]))
+            self._params_snapshot = params
         return params
     
+    def _url_params(self, **context):
+        return {key: template.render(**context) for key, template in self._params()[0]}
+    
     def _header_params(self, **context):
-        headers = {}
-        for header in self.header_parameters.all():
-            headers[header.key] = header.process(**context)
-        return headers
+        return {key: template.render(**context) for key, template in self._params()[1]}
     
     def data_required(self):
         return self.method != self.GET and self.method != self.DELETE
     
-    def process(self, **context):
+    def template_variables(self):
         """
-        Process handler request. Before executing requests render templates with context
-        
-        :param context: Processing context
-        :returns: Requests response `<http://docs.python-requests.org/en/master/api/#requests.Response>` _.
+        :returns: Variables used by url, data and parameter templates of the request
         """
-        env = Environment(extensions=['jinja2_time.TimeExtension'])
-        
-        url_template = env.from_string(self.url_template)
-        url = url_template.render(**context).replace(" ", "")
+        variables = rendering.get_variables(self.url_template, self.data if self.data_required() else None)
+        return variables.union(self._params()[2])
+    
+    def _build(self, **context):
+        url = rendering.render(self.url_template, **context).replace(" ", "")
         logger.debug("Request %s generates url %s" % (self, url))        
         params = self._url_params(**context)
         logger.debug("Request %s generates params %s" % (self, params))
         headers = self._header_params(**context)
         logger.debug("Request %s generates header %s" % (self, headers))
-        
+        kwargs = {'headers': headers, 'params': params}
         if self.data_required():
-            data_template = env.from_string(self.data)
-            data = data_template.render(**context)
+            data = rendering.render(self.data, **context)
             logger.debug("Request %s generates data %s" % (self, data))
-            r = self._get_method()(url, data=json.loads(data), headers=headers, params=params)
-        else:
-            r = self._get_method()(url, headers=headers, params=params)
-
-        return r
+            kwargs['data'] = json.loads(data)
+        return url, kwargs
+    
+    def process(self, bot_timeout=None, **context):
+        """
+        Process handler request. Before executing requests render templates with context.
+        Get responses are cached when cache_timeout is set
+        
+        :param bot_timeout: Timeout of the bot. Used when request has no timeout
+        :param context: Processing context
+        :returns: Requests response `<http://docs.python-requests.org/en/master/api/#requests.Response>` _.
+        :raises UpstreamError: :class:`UpstreamError <permabots.upstreams.UpstreamError>` when no response is received
+        """
+        url, kwargs = self._build(**context)
+        timeout = upstreams.get_timeout(self.timeout, bot_timeout)
+        if self.cache_timeout and self.method == self.GET:
+            return http_caching.request(url, self.cache_timeout, timeout=timeout, **kwargs)
+        return upstreams.request(self._get_method(), url, timeout=timeout, **kwargs)
     
 class UrlParam(AbstractParam):
     """
@@ -176,9 +197,6 @@ class Handler(PermabotsModel):
     def __str__(self):
         return "%s" % self.name
     
-    def urlpattern(self):
-        return url(self.pattern, self.process)
-                
     def process(self, bot, message, service, state_context, **pattern_context):
         """
         Process conversation message.
@@ -191,6 +209,8 @@ class Handler(PermabotsModel):
             * message: provider message
             * emoji: dict of emojis  use named notation with underscores `<http://apps.timwhitlock.info/emoji/tables/unicode>` _.
             
+           env, message and emoji are only generated when response or request templates use them.
+            
         2. Process request (if required)
         
         3. Generates response. Text and Keyboard
@@ -208,26 +228,37 @@ class Handler(PermabotsModel):
         :type pattern_context: dict
         :returns: Text and keyboard response, new state for the chat and context used.
         """
-        env = {}
-        for env_var in caching.get_or_set_related(bot, 'env_vars'):
-            env.update(env_var.as_json())
         context = {'service': service,
                    'state_context': state_context,
-                   'pattern': pattern_context,
-                   'env': env,
-                   'message': message.to_dict(),
-                   'emoji': utils.create_emoji_context()}
+                   'pattern': pattern_context}
+        # Only variables templates use are built
+        variables = self.response.template_variables()
+        if self.request:
+            variables = variables.union(self.request.template_variables())
+        if 'env' in variables:
+            context['env'] = environment.get_env(bot)
+        if 'message' in variables:
+            context['message'] = message.to_dict()
+        if 'emoji' in variables:
+            context['emoji'] = utils.create_emoji_context()
         response_context = {}
         success = True
         if self.request:
-            r = self.request.process(**context)
-            logger.debug("Handler %s get request %s" % (self, r))        
-            success = is_success(r.status_code)
-            response_context['status'] = r.status_code
             try:
-                response_context['data'] = r.json()
-            except:
+                r = self.request.process(bot_timeout=bot.request_timeout, **context)
+            except upstreams.UpstreamError as e:
+                logger.warning("Handler %s request failed: %s" % (self, e))
+                success = False
+                response_context['status'] = e.status_code
                 response_context['data'] = {}
+            else:
+                logger.debug("Handler %s get request %s" % (self, r))        
+                success = is_success(r.status_code)
+                response_context['status'] = r.status_code
+                try:
+                    response_context['data'] = r.json()
+                except:
+                    response_context['data'] = {}
         context['response'] = response_context
         response_text, response_keyboard = self.response.process(**context)
         # update ChatState
@@ -9,6 +9,7 @@ from django.db.models.signals import pre_save
 from django.dispatch import receiver
 import shortuuid
 from permabots import utils
+from permabots import environment
 
 logger = logging.getLogger(__name__)
 
@@ -49,15 +50,32 @@ class Hook(PermabotsModel):
         :param data: JSON data from hook POST
         :type: JSON
         """
-        env = {}
-        for env_var in bot.env_vars.all():
-            env.update(env_var.as_json())
-        context = {'env': env,
-                   'data': data,
-                   'emoji': utils.create_emoji_context()}
+        context = {'data': data}
+        variables = self.response.template_variables()
+        if 'env' in variables:
+            context['env'] = environment.get_env(bot)
+        if 'emoji' in variables:
+            context['emoji'] = utils.create_emoji_context()
         response_text, response_keyboard = self.response.process(**context)
         return response_text, response_keyboard   
     
+    def recipients(self, identity):
+        """
+        :param identity: Service integration identity. i.e. telegram
+        :returns: recipients of the hook for the integration
+        """
+        return getattr(self, '%s_recipients' % identity).all()
+    
+    def add_deliveries(self, identity, results):
+        """
+        Record delivery results of the hook response.
+        
+        :param identity: Service integration identity. i.e. telegram
+        :param results: list of (chat_id, success)
+        """
+        HookDelivery.objects.bulk_create([HookDelivery(hook=self, service=identity, chat_id=chat_id, success=success)
+                                          for chat_id, success in results])
+    
 @receiver(pre_save, sender=Hook)
 def set_key(sender, instance, **kwargs):
     if not instance.key:
@@ -104,4 +122,22 @@ class MessengerRecipient(PermabotsModel):
         verbose_name_plural = _('Messenger Recipients')      
         
     def __str__(self):
-        return "(%s, %s, %s)" % (self.name, self.chat_id)  
+        return "(%s, %s, %s)" % (self.name, self.chat_id)
+    
+@python_2_unicode_compatible 
+class HookDelivery(PermabotsModel):
+    """
+    Result of delivering a hook response to a recipient.
+    """
+    hook = models.ForeignKey(Hook, verbose_name=_('Hook'), related_name="deliveries",
+                             help_text=_("Hook delivered"), on_delete=models.CASCADE)
+    service = models.CharField(_('Service'), max_length=50, db_index=True, help_text=_("Service integration used. i.e. telegram"))
+    chat_id = models.CharField(_('Chat Id'), max_length=150, db_index=True, help_text=_("Chat identifier of the recipient"))
+    success = models.BooleanField(_('Success'), default=True, help_text=_("Response was sent to the recipient"))
+    
+    class Meta:
+        verbose_name = _('Hook Delivery')
+        verbose_name_plural = _('Hook Deliveries')
+        
+    def __str__(self):
+        return "(%s, %s, %s)" % (self.service, self.chat_id, self.success)
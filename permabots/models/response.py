@@ -3,9 +3,9 @@ from django.db import models
 from django.utils.encoding import python_2_unicode_compatible
 from django.utils.translation import ugettext_lazy as _
 import logging
-from jinja2 import Environment
 from permabots.models.base import PermabotsModel
 from permabots import validators
+from permabots import rendering
 
 logger = logging.getLogger(__name__)
 
@@ -28,6 +28,18 @@ class Response(PermabotsModel):
     def __str__(self):
         return "(text:%s, keyboard:%s)" % (self.text_template, self.keyboard_template)
     
+    def template_variables(self):
+        """
+        :returns: Variables used by the response templates
+        """
+        return rendering.get_variables(self.text_template, self.keyboard_template)
+    
+    def is_constant(self):
+        """
+        :returns: True if text and keyboard are always the same. i.e. templates without jinja2 syntax
+        """
+        return rendering.is_constant(self.text_template, self.keyboard_template)
+    
     def process(self, **context):
         """
         Render response templates with context
@@ -35,13 +47,10 @@ class Response(PermabotsModel):
         :param context: Context generated while processing a conversation handler or a notification hook
         :returns: Text and keyboard response
         """
-        env = Environment(extensions=['jinja2_time.TimeExtension'])
-        response_text_template = env.from_string(self.text_template)
-        response_text = response_text_template.render(**context)
+        response_text = rendering.render(self.text_template, **context)
         logger.debug("Response %s generates text  %s" % (self.text_template, response_text))
         if self.keyboard_template:
-            response_keyboard_template = env.from_string(self.keyboard_template)
-            response_keyboard = response_keyboard_template.render(**context)
+            response_keyboard = rendering.render(self.keyboard_template, **context)
         else:
             response_keyboard = None
         logger.debug("Response %s generates keyboard  %s" % (self.keyboard_template, response_keyboard))
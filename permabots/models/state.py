@@ -1,11 +1,15 @@
 # -*- coding: utf-8 -*-
 from django.db import models
+from django.db.models import F
+from django.conf import settings
+from django.utils import timezone
 from django.utils.encoding import python_2_unicode_compatible
 from django.utils.translation import ugettext_lazy as _
 import logging
 from permabots.models.base import PermabotsModel
 from permabots.models import TelegramChat, KikChat, KikUser, TelegramUser
-import json
+from permabots import contexts
+import copy
 
 logger = logging.getLogger(__name__)
 
@@ -38,19 +42,74 @@ class AbsChatState(PermabotsModel):
                                blank=True)
     state = models.ForeignKey(State, verbose_name=_('State'), related_name='%(class)s_chat',
                               help_text=_("State related to the chat"), on_delete=models.CASCADE)
+    version = models.PositiveIntegerField(_('Version'), default=0,
+                                          help_text=_("Number of updates. Used to detect concurrent updates"))
+
+    _context_value = None
+    _context_source = None
+    _context_dirty = False
 
     class Meta:
         abstract = True
         
     def _get_context(self):
-        if self.context:
-            return json.loads(self.context)
-        return {}
+        # Decoded once. Decoded again only when context is loaded from database
+        if not self._context_dirty and (self._context_value is None or self._context_source is not self.context):
+            self._context_source = self.context
+            self._context_value = contexts.loads(self.context)
+        return self._context_value
     
     def _set_context(self, value):
-        self.context = json.dumps(value)        
+        # Serialized when saved
+        self._context_value = value
+        self._context_dirty = True
     
     ctx = property(_get_context, _set_context)
+    
+    def save(self, *args, **kwargs):
+        if self._context_dirty:
+            self.context = contexts.dumps(self._context_value)
+            self._context_source = self.context
+            self._context_dirty = False
+        super(AbsChatState, self).save(*args, **kwargs)
+    
+    def compare_and_set(self, target_state, context_key, context, bot):
+        """
+        Set state and add context to the chat state only if it was not updated by other process since it was loaded.
+        
+        Only state, context, version and updated_at columns are written. When other process updated it first the chat state
+        is reloaded and the update retried up to MICROBOT_CHAT_STATE_RETRIES times, only while the chat is still in the state
+        it was loaded with. i.e. the source state of the handler. Otherwise the transition is dropped.
+        
+        :param target_state: State to set
+        :param context_key: Key to store context. i.e. name of the previous state
+        :param context: Context generated in the processing
+        :param bot: Bot whose limits are applied to the context
+        :returns: True if chat state was updated. False if the transition was dropped
+        """
+        retries = getattr(settings, 'MICROBOT_CHAT_STATE_RETRIES', 3)
+        source_state_id = self.state_id
+        for attempt in range(retries + 1):
+            state_context = contexts.limit(bot, copy.copy(self.ctx), context_key, context)
+            serialized = contexts.dumps(state_context)
+            updated_at = timezone.now()
+            if type(self).objects.filter(pk=self.pk, version=self.version).update(state=target_state,
+                                                                                   context=serialized,
+                                                                                   version=F('version') + 1,
+                                                                                   updated_at=updated_at):
+                self.state = target_state
+                self.context = self._context_source = serialized
+                self._context_value = state_context
+                self.version += 1
+                self.updated_at = updated_at
+                return True
+            logger.debug("Chat state %s updated concurrently. Attempt %d" % (self.pk, attempt + 1))
+            self.refresh_from_db(fields=['state', 'context', 'version'])
+            if self.state_id != source_state_id:
+                logger.warning("Chat state %s moved to %s concurrently. Transition to %s dropped" % (self.pk, self.state, target_state))
+                return False
+        logger.error("Chat state %s not updated after %d attempts" % (self.pk, retries + 1))
+        return False
 
 
 @python_2_unicode_compatible    
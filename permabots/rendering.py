@@ -0,0 +1,90 @@
+# -*- coding: utf-8 -*-
+from jinja2 import Environment, meta, nodes
+from django.conf import settings
+from collections import OrderedDict
+from six import text_type
+import hashlib
+import threading
+import logging
+
+logger = logging.getLogger(__name__)
+
+_environment = None
+_templates = OrderedDict()
+_lock = threading.Lock()
+
+
+def get_environment():
+    """
+    Jinja2 environment shared by every template rendered in the process.
+    """
+    global _environment
+    if _environment is None:
+        _environment = Environment(extensions=['jinja2_time.TimeExtension'])
+    return _environment
+
+def generate_key(source):
+    return hashlib.sha1(text_type(source).encode('utf-8')).hexdigest()
+
+def _is_constant(parsed):
+    return all(isinstance(node, nodes.Output) and all(isinstance(child, nodes.TemplateData) for child in node.nodes)
+               for node in parsed.body)
+
+def _get(source):
+    key = generate_key(source)
+    with _lock:
+        entry = _templates.pop(key, None)
+        if entry is not None:
+            _templates[key] = entry
+            return entry
+    environment = get_environment()
+    parsed = environment.parse(source)
+    # Template is analysed once when compiled. Templates without jinja2 syntax are rendered only once
+    template = environment.from_string(parsed)
+    constant = template.render() if _is_constant(parsed) else None
+    entry = template, frozenset(meta.find_undeclared_variables(parsed)), constant
+    with _lock:
+        _templates[key] = entry
+        while len(_templates) > getattr(settings, 'MICROBOT_TEMPLATE_CACHE_SIZE', 1000):
+            _templates.popitem(last=False)
+    return entry
+
+def get_template(source):
+    """
+    Obtain compiled template from process cache. Least recently used templates are discarded
+    when MICROBOT_TEMPLATE_CACHE_SIZE is reached.
+
+    :param source: Template source in jinja2 format
+    :returns: Compiled jinja2 template
+    """
+    return _get(source)[0]
+
+def get_variables(*sources):
+    """
+    Obtain top level variables templates use, so only those are added to the render context.
+
+    :param sources: Template sources in jinja2 format. Empty ones are skipped
+    :returns: frozenset of variable names
+    """
+    variables = frozenset()
+    for source in sources:
+        if source:
+            variables = variables.union(_get(source)[1])
+    return variables
+
+def is_constant(*sources):
+    """
+    :param sources: Template sources in jinja2 format. Empty ones are skipped
+    :returns: True if templates render always the same text
+    """
+    return all(_get(source)[2] is not None for source in sources if source)
+
+def render(source, **context):
+    template, variables, constant = _get(source)
+    if constant is not None:
+        return constant
+    return template.render(**context)
+
+def clear():
+    with _lock:
+        _templates.clear()
@@ -0,0 +1,130 @@
+# -*- coding: utf-8 -*-
+import re
+import uuid
+import logging
+from django.core.cache import cache
+from permabots import caching
+
+logger = logging.getLogger(__name__)
+
+#  Routers live in process memory. A version shared through the cache lets every process
+#  know when its router is outdated because handlers were changed in another one.
+_routers = {}
+
+
+class Route(object):
+    """
+    Handler with its pattern already compiled.
+    """
+
+    def __init__(self, handler):
+        self.handler = handler
+        self.regex = re.compile(handler.pattern)
+
+    def match(self, text):
+        match = self.regex.search(text)
+        if match:
+            # Only named groups are passed to the handler as pattern context
+            return {k: v for k, v in match.groupdict().items() if v is not None}
+        return None
+
+
+class HandlerRouter(object):
+    """
+    Compiled routing table for the enabled handlers of a bot.
+
+    Handlers are grouped by source state keeping priority order, so only handlers valid for the chat state
+    are checked. First handler whose pattern matches the text wins.
+    """
+
+    def __init__(self, index, version=None):
+        """
+        :param index: dict of candidate handlers in priority order by source state id. None key for handlers without source states
+        :param version: version of the bot handlers used to build the router
+        """
+        self.version = version
+        routes = {}
+        self._by_state = {}
+        for state_id, handlers in index.items():
+            self._by_state[state_id] = [routes.setdefault(handler.pk, Route(handler)) for handler in handlers]
+        self._stateless = self._by_state.get(None, [])
+
+    def routes(self, state_id=None):
+        if state_id is None:
+            return self._stateless
+        return self._by_state.get(state_id, self._stateless)
+
+    def resolve(self, text, state_id=None):
+        """
+        Find the handler for a text message.
+
+        :param text: Text from the message
+        :param state_id: State identifier of the chat. None if the chat has no state yet
+        :returns: handler and dict of variables from its pattern or None if no handler matches
+        """
+        text = str(text)
+        for route in self.routes(state_id):
+            pattern_context = route.match(text)
+            if pattern_context is not None:
+                return route.handler, pattern_context
+        return None
+
+
+def _version_key(bot):
+    return caching.generate_key(bot._meta.model, bot.pk, 'router')
+
+def _index_key(bot):
+    return caching.generate_key(bot._meta.model, bot.pk, 'handler_index')
+
+def _get_version(bot):
+    key = _version_key(bot)
+    version = cache.get(key)
+    if version is None:
+        cache.add(key, uuid.uuid4().hex)
+        version = cache.get(key)
+    return version
+
+def build_index(handlers):
+    """
+    Group handlers by source state.
+
+    :param handlers: enabled handlers in priority order with source states prefetched
+    :returns: dict of candidate handlers by state id. None key for handlers without source states
+    """
+    handlers = [(handler, frozenset(state.pk for state in handler.source_states.all())) for handler in handlers]
+    state_ids = set()
+    for handler, source_states in handlers:
+        state_ids.update(source_states)
+    index = {None: [handler for handler, source_states in handlers if not source_states]}
+    for state_id in state_ids:
+        index[state_id] = [handler for handler, source_states in handlers if not source_states or state_id in source_states]
+    return index
+
+def get_or_set_index(bot):
+    key = _index_key(bot)
+    index = cache.get(key)
+    if index is None:
+        handlers = bot.handlers.filter(enabled=True).select_related('response', 'request', 'target_state') \
+            .prefetch_related('source_states', 'request__url_parameters', 'request__header_parameters')
+        index = build_index(handlers)
+        cache.set(key, index)
+    return index
+
+def get_router(bot):
+    """
+    Obtain compiled router for the bot. It is only built again when its handlers change.
+
+    :param bot: Bot :class:`Bot <permabots.models.bot.Bot>`
+    :returns: :class:`HandlerRouter <permabots.routing.HandlerRouter>`
+    """
+    version = _get_version(bot)
+    router = _routers.get(bot.pk)
+    if router is None or version is None or router.version != version:
+        logger.debug("Building router for bot %s with version %s" % (bot, version))
+        router = HandlerRouter(get_or_set_index(bot), version)
+        _routers[bot.pk] = router
+    return router
+
+def delete(bot):
+    _routers.pop(bot.pk, None)
+    cache.delete_many([_index_key(bot), _version_key(bot)])
@@ -0,0 +1,69 @@
+# -*- coding: utf-8 -*-
+from django.conf import settings
+from six import text_type
+import zlib
+import logging
+
+logger = logging.getLogger(__name__)
+
+#  Messages of a chat are always sent to the same queue. Running one worker process per queue
+#  handles each chat in order while different chats are handled in parallel.
+#  Responses can be delivered by other workers consuming MICROBOT_DELIVERY_QUEUE.
+
+
+def get_chat_queues():
+    return getattr(settings, 'MICROBOT_CHAT_QUEUES', 0)
+
+def get_delivery_queue():
+    return getattr(settings, 'MICROBOT_DELIVERY_QUEUE', None)
+
+def _partition(chat_id, queues):
+    return zlib.crc32(text_type(chat_id).encode('utf-8')) % queues
+
+def get_queue(chat_id):
+    """
+    Obtain queue for a chat hashing its identifier. Hash is stable between processes.
+
+    :param chat_id: Chat identifier from the provider
+    :returns: Queue name or None if MICROBOT_CHAT_QUEUES is not set
+    """
+    queues = get_chat_queues()
+    if not queues:
+        return None
+    return '%s.%d' % (getattr(settings, 'MICROBOT_CHAT_QUEUE_PREFIX', 'permabots.chat'), _partition(chat_id, queues))
+
+def task_options(chat_id):
+    """
+    :returns: dict of options for apply_async routing the task to the queue of the chat
+    """
+    queue = get_queue(chat_id)
+    if queue is None:
+        return {}
+    return {'queue': queue}
+
+def delivery_options(chat_id=None):
+    """
+    Responses of a chat are partitioned like its messages when MICROBOT_CHAT_QUEUES is set so they keep their order.
+
+    :param chat_id: Chat identifier of the response. None for deliveries to several chats
+    :returns: dict of options for apply_async routing the task to the delivery queue
+    """
+    queue = get_delivery_queue()
+    if not queue:
+        return {}
+    queues = get_chat_queues()
+    if chat_id is not None and queues:
+        queue = '%s.%d' % (queue, _partition(chat_id, queues))
+    return {'queue': queue}
+
+def telegram_chat_id(data):
+    """
+    :param data: Update serialized with :class:`UpdateSerializer <permabots.serializers.telegram_api.UpdateSerializer>`
+    :returns: Chat identifier of the update
+    """
+    if 'message' in data:
+        return data['message']['chat']['id']
+    if 'message' in data['callback_query']:
+        return data['callback_query']['message']['chat']['id']
+    # Old callback queries without message are ordered by user
+    return data['callback_query']['from']['id']
@@ -19,7 +19,7 @@ class RequestSerializer(serializers.HyperlinkedModelSerializer):
     
     class Meta:
         model = Request
-        fields = ('url_template', 'method', 'data', 'url_parameters', 'header_parameters')
+        fields = ('url_template', 'method', 'data', 'timeout', 'cache_timeout', 'url_parameters', 'header_parameters')
         
 class RequestUpdateSerializer(RequestSerializer):
     url_template = serializers.CharField(required=False, max_length=255, validators=[validators.validate_template],
@@ -93,6 +93,8 @@ class HandlerSerializer(serializers.ModelSerializer):
             instance.request.url_template = validated_data['request'].get('url_template', instance.request.url_template)
             instance.request.method = validated_data['request'].get('method', instance.request.method)
             instance.request.data = validated_data['request'].get('data', instance.request.data)
+            instance.request.timeout = validated_data['request'].get('timeout', instance.request.timeout)
+            instance.request.cache_timeout = validated_data['request'].get('cache_timeout', instance.request.cache_timeout)
             instance.request.save()
         
             if 'url_parameters' in validated_data['request']:
@@ -4,6 +4,10 @@ import logging
 from permabots.validators import validate_token
 from django.apps import apps
 from permabots import caching
+from permabots import clients
+from permabots import chat_states
+from permabots import environment
+from permabots import routing
 
 logger = logging.getLogger(__name__)
 
@@ -61,15 +65,43 @@ def validate_bot(sender, instance, **kwargs):
     
 def delete_cache(sender, instance, **kwargs):
     caching.delete(sender, instance)
+    clients.delete(instance)
+    
+def delete_previous_chat_state(sender, instance, **kwargs):
+    # chat, user or state could be changed through the api
+    if not instance._state.adding:
+        previous = sender.objects.select_related('state').filter(pk=instance.pk).first()
+        if previous:
+            chat_states.delete(previous)
+    
+def set_chat_state(sender, instance, **kwargs):
+    chat_states.set(instance)
+    
+def delete_chat_state(sender, instance, **kwargs):
+    chat_states.delete(instance)
     
 def delete_cache_env_vars(sender, instance, **kwargs):
     caching.delete(instance.bot._meta.model, instance.bot, 'env_vars')
+    environment.delete(instance.bot)
     
 def delete_cache_handlers(sender, instance, **kwargs):
-    caching.delete(instance.bot._meta.model, instance.bot, 'handlers')
+    routing.delete(instance.bot)
     
 def delete_cache_source_states(sender, instance, **kwargs):
-    caching.delete(instance._meta.model, instance, 'source_states')
+    # instance is a Handler or a State depending on the side of the relation changed
+    routing.delete(instance.bot)
+    
+def delete_cache_requests(sender, instance, **kwargs):
+    # instance is a Request or one of its parameters
+    bot_model = apps.get_model("permabots", "Bot")
+    for bot in bot_model.objects.filter(handlers__request=getattr(instance, 'request_id', instance.pk)).distinct():
+        routing.delete(bot)
+    
+def delete_cache_responses(sender, instance, **kwargs):
+    # Router index keeps the responses of the handlers
+    bot_model = apps.get_model("permabots", "Bot")
+    for bot in bot_model.objects.filter(handlers__response=instance.pk).distinct():
+        routing.delete(bot)
     
 def delete_bot_integrations(sender, instance, **kwargs):
     if instance.telegram_bot:
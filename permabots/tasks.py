@@ -1,13 +1,23 @@
 from __future__ import absolute_import
 from celery import shared_task
 from permabots.models import TelegramUpdate, TelegramBot, Hook, KikMessage, KikBot, MessengerMessage, MessengerBot
+from collections import OrderedDict
 import logging
 import traceback
 import sys
 from permabots import caching
+from permabots import ingestion
+from permabots import keyboards
+from permabots import http_caching
+from permabots import scheduling
+from permabots import throttling
 
 logger = logging.getLogger(__name__)
 
+INTEGRATIONS = {'telegram': TelegramBot,
+                'kik': KikBot,
+                'messenger': MessengerBot}
+
 @shared_task
 def handle_update(update_id, bot_id):
     try:
@@ -21,7 +31,6 @@ def handle_update(update_id, bot_id):
         logger.error("Error handling update %s from bot %s" % (update_id, bot_id))
     else:
         try:
-            telegram_bot.init_bot()
             telegram_bot.bot.handle_message(update, telegram_bot)
         except:           
             exc_info = sys.exc_info()
@@ -53,6 +62,105 @@ def handle_message(message_id, bot_id):
             # Each update is only used once
             caching.delete(KikMessage, message)
             
+@shared_task
+def handle_ephemeral_update(data, bot_id):
+    try:
+        telegram_bot = caching.get_or_set(TelegramBot, bot_id)
+    except TelegramBot.DoesNotExist:
+        logger.error("Bot  %s does not exists or disabled" % bot_id)
+    else:
+        try:
+            update = ingestion.build_telegram_update(data, telegram_bot)
+            telegram_bot.bot.handle_message(update, telegram_bot)
+        except:           
+            exc_info = sys.exc_info()
+            traceback.print_exception(*exc_info)
+            logger.error("Error processing %s for bot %s" % (data, telegram_bot))
+            
+def _handle_message(bot_service, message, outbox=None):
+    try:
+        bot_service.bot.handle_message(message, bot_service, outbox)
+    except:           
+        exc_info = sys.exc_info()
+        traceback.print_exception(*exc_info)
+        logger.error("Error processing %s for bot %s" % (message, bot_service))
+        return False
+    return True
+
+@shared_task
+def handle_ephemeral_kik_messages(messages, bot_id):
+    try:
+        kik_bot = caching.get_or_set(KikBot, bot_id)
+    except KikBot.DoesNotExist:
+        logger.error("Bot  %s does not exists or disabled" % bot_id)
+    else:
+        try:
+            messages = ingestion.build_kik_messages(messages)
+        except:           
+            exc_info = sys.exc_info()
+            traceback.print_exception(*exc_info)
+            logger.error("Error processing %s for bot %s" % (messages, kik_bot))
+        else:
+            outbox = []
+            for message in messages:
+                _handle_message(kik_bot, message, outbox)
+            deliver_responses(kik_bot, outbox)
+            
+@shared_task
+def handle_ephemeral_messenger_messages(messages, bot_id):
+    try:
+        messenger_bot = caching.get_or_set(MessengerBot, bot_id)
+    except MessengerBot.DoesNotExist:
+        logger.error("Bot  %s does not exists or disabled" % bot_id)
+    else:
+        outbox = []
+        for data in messages:
+            try:
+                message = ingestion.build_messenger_message(data, messenger_bot)
+            except:           
+                exc_info = sys.exc_info()
+                traceback.print_exception(*exc_info)
+                logger.error("Error processing %s for bot %s" % (data, messenger_bot))
+            else:
+                _handle_message(messenger_bot, message, outbox)
+        deliver_responses(messenger_bot, outbox)
+            
+@shared_task
+def handle_kik_messages(message_ids, bot_id):
+    """
+    Handle in order messages from the same sender received in one webhook request
+    """
+    try:
+        kik_bot = caching.get_or_set(KikBot, bot_id)
+    except KikBot.DoesNotExist:
+        logger.error("Bot  %s does not exists or disabled" % bot_id)
+    else:
+        messages = caching.get_or_set_many(KikMessage, message_ids)
+        if len(messages) < len(message_ids):
+            logger.error("Messages %s do not exist" % set(message_ids).difference(str(message.id) for message in messages))
+        outbox = []
+        # Each message is only used once
+        caching.delete_many(KikMessage, [message for message in messages if _handle_message(kik_bot, message, outbox)])
+        deliver_responses(kik_bot, outbox)
+        
+@shared_task
+def handle_messenger_messages(message_ids, bot_id):
+    """
+    Handle in order messages from the same sender received in one webhook request
+    """
+    try:
+        messenger_bot = caching.get_or_set(MessengerBot, bot_id)
+    except MessengerBot.DoesNotExist:
+        logger.error("Bot  %s does not exists or disabled" % bot_id)
+    else:
+        messages = caching.get_or_set_many(MessengerMessage, message_ids)
+        if len(messages) < len(message_ids):
+            logger.error("Messages %s do not exist" % set(message_ids).difference(str(message.id) for message in messages))
+        outbox = []
+        # Each message is only used once
+        caching.delete_many(MessengerMessage, [message for message in messages if _handle_message(messenger_bot, message, outbox)])
+        deliver_responses(messenger_bot, outbox)
+        
 @shared_task          
 def handle_messenger_message(message_id, bot_id):
     try:
@@ -89,3 +197,78 @@ def handle_hook(hook_id, data):
             exc_info = sys.exc_info()
             traceback.print_exception(*exc_info)
             logger.error("Error processing %s for bot %s" % (hook, hook.bot))
+            
+@shared_task(bind=True, max_retries=None)
+def handle_hook_recipients(self, hook_id, identity, recipient_ids, text, keyboard, first=0):
+    """
+    Recipients not sent because of throttling are sent by the task again after the time to wait
+    """
+    try:
+        hook = Hook.objects.select_related('bot').get(id=hook_id)
+    except Hook.DoesNotExist:
+        logger.error("Hook %s does not exists" % hook_id)
+    else:
+        try:
+            hook.bot.handle_hook_recipients(hook, identity, recipient_ids, text, keyboard, first)
+        except throttling.Throttled as e:
+            raise self.retry(args=(hook_id, identity, e.recipient_ids, text, keyboard, e.sent), countdown=e.countdown)
+        except:           
+            exc_info = sys.exc_info()
+            traceback.print_exception(*exc_info)
+            logger.error("Error delivering %s to %s recipients for bot %s" % (hook, identity, hook.bot))
+
+def deliver_responses(bot_service, responses, sent=0, failures=0, countdown=None):
+    """
+    Deliver responses by delivery tasks. Responses of the same chat are sent in order by one task.
+    
+    :param bot_service: Service Integration
+    :param responses: list of (chat_id, text, keyboard, send_message options)
+    :param sent: Messages of the first response already sent
+    :param failures: Errors sending the first response
+    :param countdown: Seconds to wait before sending
+    """
+    chats = OrderedDict()
+    for chat_id, text, keyboard, options in responses:
+        chats.setdefault(chat_id, []).append((text, keyboard, options))
+    for chat_id, chat_responses in chats.items():
+        deliver_message.apply_async((bot_service.identity, bot_service.pk, chat_id, chat_responses, sent, failures),
+                                    countdown=countdown, **scheduling.delivery_options(chat_id))
+        sent, failures, countdown = 0, 0, None
+
+@shared_task(bind=True, max_retries=None)
+def deliver_message(self, identity, bot_id, chat_id, responses, sent=0, failures=0):
+    """
+    Send responses to a chat in order. When a message is not sent the task is retried from it, after the time to wait
+    when throttled or with backoff when it failed. See :func:`permabots.throttling.get_retry`
+    
+    :param responses: list of (text, keyboard, send_message options)
+    :param sent: Messages of the first response already sent
+    :param failures: Errors sending the first response
+    """
+    model = INTEGRATIONS[identity]
+    try:
+        bot_service = caching.get_or_set(model, bot_id)
+    except model.DoesNotExist:
+        logger.error("Bot  %s does not exists" % bot_id)
+    else:
+        if not bot_service.enabled:
+            logger.warning("Response to %s not delivered by disabled bot %s" % (chat_id, bot_service))
+            return
+        for index, (text, keyboard, options) in enumerate(responses):
+            try:
+                bot_service.send_message(chat_id, text, keyboards.get_or_build(bot_service, keyboard), first=sent, **options)
+            except throttling.SendError as e:
+                retry = throttling.get_retry(e, failures)
+                if retry is not None:
+                    failures, countdown = retry
+                    raise self.retry(args=(identity, bot_id, chat_id, responses[index:], e.sent, failures), countdown=countdown)
+                logger.error("Response to %s for bot %s not sent after %d attempts: %s" % (chat_id, bot_service, failures + 1, e))
+            except:           
+                exc_info = sys.exc_info()
+                traceback.print_exception(*exc_info)
+                logger.error("Error delivering response to %s for bot %s" % (chat_id, bot_service))
+            sent, failures = 0, 0
+
+@shared_task
+def refresh_request_cache(url, cache_timeout, timeout, params, headers):
+    http_caching.refresh(url, cache_timeout, timeout, params, headers)
@@ -35,8 +35,8 @@ class BaseTestBot(TestCase):
 
     def setUp(self):
         with mock.patch("telegram.bot.Bot.set_webhook", callable=mock.MagicMock()):
-            with mock.patch("kik.api.KikApi.set_configuration", callable=mock.MagicMock()):
-                with mock.patch("messengerbot.MessengerClient.subscribe_app", callable=mock.MagicMock()):
+            with mock.patch("permabots.connections.KikClient.set_configuration", callable=mock.MagicMock()):
+                with mock.patch("permabots.connections.MessengerBotClient.subscribe_app", callable=mock.MagicMock()):
                     with mock.patch("telegram.bot.Bot.get_me", callable=mock.MagicMock()) as mock_get_me:
                         user_dict = {'username': u'Microbot_test_bot', 'first_name': u'Microbot_test', 'id': 204840063}
                         mock_get_me.return_value = User(**user_dict)
@@ -194,7 +194,7 @@ class KikTestBot(BaseTestBot):
     
     def setUp(self):
         super(KikTestBot, self).setUp()
-        self.send_message_to_patch = 'kik.api.KikApi.send_messages'
+        self.send_message_to_patch = 'permabots.connections.KikClient.send_messages'
         self.webhook_url = self.kik_webhook_url
         self.message_api = self.kik_messages
 
@@ -262,7 +262,7 @@ class MessengerTestBot(BaseTestBot):
       
     def setUp(self):
         super(MessengerTestBot, self).setUp()
-        self.send_message_to_patch = 'messengerbot.MessengerClient.send'
+        self.send_message_to_patch = 'permabots.connections.MessengerBotClient.send'
         self.webhook_url = self.messenger_webhook_url
         self.message_api = self.messenger_webhook_message
 
@@ -0,0 +1,161 @@
+# -*- coding: utf-8 -*-
+from django.core.cache import cache
+from django.conf import settings
+import time
+import logging
+
+logger = logging.getLogger(__name__)
+
+#  Messages per second allowed by each provider for a bot
+DEFAULT_RATE_LIMITS = {'telegram': 30,
+                       'kik': 50,
+                       'messenger': 50}
+
+#  (messages, seconds) allowed by each provider for a chat. Messages can be sent in bursts inside the period
+DEFAULT_CHAT_RATE_LIMITS = {'telegram': {'private': (5, 5),
+                                         'group': (20, 60)}}
+DEFAULT_SEND_RETRIES = 3
+#  Seconds before sending again after the first error. Doubled on each error
+DEFAULT_SEND_BACKOFF = 2
+
+
+class SendError(Exception):
+    """
+    Response not completely sent. Sending is retried by a task from the message that failed when the error is transient.
+
+    :param sent: Messages of the response sent before the error
+    :param transient: Sending again may succeed. i.e. timeouts or provider unavailable. Responses failing with other
+        errors like blocked users or wrong chat ids are not sent again
+    """
+
+    def __init__(self, message, sent=0, transient=True):
+        super(SendError, self).__init__(message)
+        self.sent = sent
+        self.transient = transient
+        #  Seconds to wait before sending again. None to retry with backoff
+        self.countdown = None
+        #  (chat_id, success) of recipients already sent. Set by send_bulk_message
+        self.results = []
+        #  Identifiers of hook recipients not sent yet. Set by handle_hook_recipients
+        self.recipient_ids = []
+
+
+class Throttled(SendError):
+    """
+    Messages can not be sent yet because a rate limit was reached or the provider asked to wait. Workers do not sleep,
+    sending is retried by a task after countdown seconds.
+
+    :param countdown: Seconds to wait before sending
+    """
+
+    def __init__(self, countdown, sent=0):
+        super(Throttled, self).__init__("Retry after %.2f seconds" % countdown, sent)
+        self.countdown = countdown
+
+
+def get_rate_limit(identity):
+    return getattr(settings, 'MICROBOT_RATE_LIMITS', DEFAULT_RATE_LIMITS).get(identity)
+
+def get_chat_rate_limit(identity, chat_type):
+    return getattr(settings, 'MICROBOT_CHAT_RATE_LIMITS', DEFAULT_CHAT_RATE_LIMITS).get(identity, {}).get(chat_type)
+
+def get_send_retries():
+    return getattr(settings, 'MICROBOT_SEND_RETRIES', DEFAULT_SEND_RETRIES)
+
+def get_backoff(failures):
+    return getattr(settings, 'MICROBOT_SEND_BACKOFF', DEFAULT_SEND_BACKOFF) * 2 ** (failures - 1)
+
+def get_retry(error, failures):
+    """
+    When to send a response again after an error. Throttled responses are always sent again after the time to wait,
+    failed ones up to MICROBOT_SEND_RETRIES times with exponential backoff when the error is transient.
+
+    :param error: SendError raised sending the response
+    :param failures: Errors sending the response before this one
+    :returns: (failures, countdown) or None if the response must not be sent again
+    """
+    if isinstance(error, Throttled):
+        return failures, error.countdown
+    if not error.transient:
+        return None
+    failures += 1
+    if failures > get_send_retries():
+        return None
+    return failures, get_backoff(failures)
+
+def _pause_key(bot_service):
+    return 'permabots.throttle.%s-%s-paused' % (bot_service.identity, bot_service.pk)
+
+def _acquire(key_prefix, limit, period, messages):
+    now = time.time()
+    window = int(now // period)
+    key = '%s-%d' % (key_prefix, window)
+    cache.add(key, 0, period + 1)
+    try:
+        count = cache.incr(key, messages)
+    except ValueError:
+        # expired between add and incr
+        count = messages
+        cache.set(key, count, period + 1)
+    # a request bigger than the limit is only sent as the first one in its window
+    if count <= limit or count == messages:
+        return key
+    _release(key, messages)
+    logger.debug("Rate limit %s in %s seconds reached for %s" % (limit, period, key_prefix))
+    raise Throttled((window + 1) * period - now)
+
+def _release(key, messages):
+    try:
+        cache.decr(key, messages)
+    except ValueError:
+        pass
+
+def throttle(bot_service, messages=1):
+    """
+    Count messages sent with the integration checking MICROBOT_RATE_LIMITS is not exceeded.
+
+    Counters are kept in cache so the limit is shared by every worker sending messages for the same bot.
+    Messages are not sent either while the provider asked to pause the bot.
+
+    :param bot_service: Service Integration
+    :type bot_service: IntegrationBot :class:`IntegrationBot <permabots.models.bot.IntegrationBot>`
+    :param messages: Number of messages sent in the same request
+    :raises Throttled: when messages can not be sent yet
+    """
+    paused_until = cache.get(_pause_key(bot_service))
+    if paused_until:
+        delay = paused_until - time.time()
+        if delay > 0:
+            logger.debug("Bot %s paused %s seconds" % (bot_service, delay))
+            raise Throttled(delay)
+    limit = get_rate_limit(bot_service.identity)
+    if not limit:
+        return
+    _acquire('permabots.throttle.%s-%s' % (bot_service.identity, bot_service.pk), limit, 1, messages)
+
+def throttle_chat(bot_service, chat_id, chat_type, messages=1):
+    """
+    Count messages sent to a chat checking MICROBOT_CHAT_RATE_LIMITS is not exceeded and then count them with the
+    integration with :func:`throttle`. Messages throttled by their chat do not use messages allowed for the bot, and
+    messages of the chat are given back when the bot is throttled.
+
+    :param chat_id: Chat identifier
+    :param chat_type: Type of chat in MICROBOT_CHAT_RATE_LIMITS. i.e. private or group
+    :param messages: Number of messages sent in the same request
+    :raises Throttled: when messages can not be sent yet
+    """
+    limit = get_chat_rate_limit(bot_service.identity, chat_type)
+    if not limit:
+        return throttle(bot_service, messages)
+    key = _acquire('permabots.throttle.%s-%s-%s' % (bot_service.identity, bot_service.pk, chat_id), limit[0], limit[1], messages)
+    try:
+        throttle(bot_service, messages)
+    except Throttled:
+        _release(key, messages)
+        raise
+
+def pause(bot_service, seconds):
+    """
+    Stop sending messages of the bot from every worker. i.e. when the provider answers with a retry after error
+    """
+    cache.set(_pause_key(bot_service), time.time() + seconds, seconds + 1)
@@ -0,0 +1,130 @@
+# -*- coding: utf-8 -*-
+from django.core.cache import cache
+from django.conf import settings
+from permabots import connections
+import requests
+import threading
+import logging
+try:
+    from urllib.parse import urlparse
+except ImportError:
+    from urlparse import urlparse  # noqa
+
+logger = logging.getLogger(__name__)
+
+#  Handler requests call apis configured by bot owners. Each request has a timeout, concurrent requests to a host
+#  are capped in each process and hosts failing for every bot are short-circuited by a breaker shared in cache,
+#  so a slow upstream can not pin every worker of the platform.
+
+#  Seconds to connect and to read the response
+DEFAULT_TIMEOUT = (3.05, 10)
+DEFAULT_HOST_CONCURRENCY = 10
+#  Failures of a host in period seconds opening its circuit for reset seconds
+DEFAULT_CIRCUIT_BREAKER = {'failures': 5,
+                           'period': 60,
+                           'reset': 30}
+
+_semaphores = {}
+_lock = threading.Lock()
+
+
+class UpstreamError(Exception):
+    """
+    Request not performed or failed before a response was received. status_code is the one used in the context.
+    """
+
+    def __init__(self, status_code, message):
+        super(UpstreamError, self).__init__(message)
+        self.status_code = status_code
+
+
+def get_timeout(*timeouts):
+    """
+    First timeout set. i.e. of the request and of its bot. MICROBOT_REQUEST_TIMEOUT if none.
+    """
+    for timeout in timeouts:
+        if timeout:
+            return timeout
+    return getattr(settings, 'MICROBOT_REQUEST_TIMEOUT', DEFAULT_TIMEOUT)
+
+def get_host_concurrency():
+    return getattr(settings, 'MICROBOT_REQUEST_HOST_CONCURRENCY', DEFAULT_HOST_CONCURRENCY)
+
+def get_circuit_breaker():
+    circuit_breaker = dict(DEFAULT_CIRCUIT_BREAKER)
+    circuit_breaker.update(getattr(settings, 'MICROBOT_CIRCUIT_BREAKER', {}))
+    return circuit_breaker
+
+def _host(url):
+    return urlparse(url).netloc
+
+def _connect_timeout(timeout):
+    return timeout[0] if isinstance(timeout, (tuple, list)) else timeout
+
+def _keys(host):
+    return 'permabots.circuit.%s-open' % host, 'permabots.circuit.%s-failures' % host
+
+def _check(host):
+    """
+    Raise when circuit of the host is open. Returns failures counted.
+    """
+    open_key, failures_key = _keys(host)
+    values = cache.get_many([open_key, failures_key])
+    if values.get(open_key):
+        raise UpstreamError(503, "Circuit open for %s" % host)
+    return values.get(failures_key, 0)
+
+def _record(host, failures, failed):
+    open_key, failures_key = _keys(host)
+    if not failed:
+        if failures:
+            cache.delete(failures_key)
+        return
+    circuit_breaker = get_circuit_breaker()
+    cache.add(failures_key, 0, circuit_breaker['period'])
+    try:
+        failures = cache.incr(failures_key)
+    except ValueError:
+        failures = 1
+        cache.set(failures_key, failures, circuit_breaker['period'])
+    if failures >= circuit_breaker['failures']:
+        logger.warning("Circuit opened for %s during %s seconds after %s failures" % (host, circuit_breaker['reset'], failures))
+        cache.set(open_key, True, circuit_breaker['reset'])
+        # Half open after reset. One more failure opens it again
+        cache.set(failures_key, circuit_breaker['failures'] - 1, circuit_breaker['reset'] + circuit_breaker['period'])
+
+def _semaphore(host):
+    with _lock:
+        if host not in _semaphores:
+            _semaphores[host] = threading.BoundedSemaphore(get_host_concurrency())
+        return _semaphores[host]
+
+def request(method, url, timeout=None, **kwargs):
+    """
+    Perform http request with the shared session applying timeout, host concurrency cap and circuit breaker.
+
+    :param method: Http method. i.e. GET
+    :param url: Url to request
+    :param timeout: Seconds or (connect, read) seconds. MICROBOT_REQUEST_TIMEOUT if not set
+    :returns: `requests.Response <http://docs.python-requests.org/en/master/api/#requests.Response>` _.
+    :raises UpstreamError: when circuit is open, host is busy, request times out or connection fails
+    """
+    timeout = get_timeout(timeout)
+    host = _host(url)
+    failures = _check(host)
+    semaphore = _semaphore(host)
+    # Wait for a slot no longer than for a connection
+    if not semaphore.acquire(True, _connect_timeout(timeout)):
+        raise UpstreamError(503, "Too many concurrent requests to %s" % host)
+    try:
+        response = connections.get_session().request(method, url, timeout=timeout, **kwargs)
+    except requests.Timeout:
+        _record(host, failures, True)
+        raise UpstreamError(504, "Request to %s timed out" % host)
+    except requests.ConnectionError:
+        _record(host, failures, True)
+        raise UpstreamError(502, "Connection to %s failed" % host)
+    finally:
+        semaphore.release()
+    _record(host, failures, response.status_code >= 500)
+    return response
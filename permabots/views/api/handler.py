@@ -30,7 +30,9 @@ class HandlerList(ListBotAPIView):
                 data = json.dumps(data)
             request = Request.objects.create(url_template=serializer.data['request']['url_template'],
                                              method=serializer.data['request']['method'],
-                                             data=data)
+                                             data=data,
+                                             timeout=serializer.data['request'].get('timeout'),
+                                             cache_timeout=serializer.data['request'].get('cache_timeout'))
 
         response = handlerResponse.objects.create(text_template=serializer.data['response']['text_template'],
                                                   keyboard_template=serializer.data['response']['keyboard_template'])
@@ -1,68 +1,103 @@
 from rest_framework.views import APIView
 from permabots.serializers import KikMessageSerializer
-from permabots.models import KikBot, KikUser, KikChat, KikMessage
+from permabots.models import KikBot, KikMessage
 from rest_framework.response import Response
 from rest_framework import status
 import logging
-from permabots.tasks import handle_message
-from datetime import datetime
+from permabots.tasks import handle_kik_messages, handle_ephemeral_kik_messages
+from celery import group
 from permabots import caching
+from permabots import ingestion
+from permabots import scheduling
 import sys
 import traceback
 
 logger = logging.getLogger(__name__)
 
-class OnlyTextMessages(Exception):
-    pass
-
 
 class KikHookView(APIView):
     """
     View for Kik webhook.
     """
+    model = KikBot
     
-    def create_user(self, username):
-        try:
-            user = caching.get_or_set(KikUser, username)
-        except KikUser.DoesNotExist:
-            user, _ = KikUser.objects.get_or_create(username=username)
-        return user
-    
-    def create_message(self, serializer, bot):
-        sender = self.create_user(serializer.data['from'])
-        try:
-            chat = caching.get_or_set(KikChat, serializer.data['chatId'])
-        except KikChat.DoesNotExist:
-            chat, _ = KikChat.objects.get_or_create(id=serializer.data['chatId'])
-            if 'participants' in serializer.data:
-                for participant in serializer.data['participants']:
-                    chat.participants.add(self.create_user(participant))                    
-        if serializer.data['type'] == 'start-chatting':
-            body = "/start"
-        elif serializer.data['type'] == 'scan-data':
-            body = "/start"
-        else:
-            body = serializer.data['body']
-        message, _ = KikMessage.objects.get_or_create(message_id=serializer.data['id'],
-                                                      from_user=sender,
-                                                      timestamp=datetime.fromtimestamp(serializer.data['timestamp']),
-                                                      chat=chat,
-                                                      body=body)
-        
-        caching.set(message)
-        return message
+    def create_messages(self, messages):
+        messages = ingestion.build_kik_messages(messages)
+        messages = ingestion.save_messages(KikMessage, messages, lambda message: str(message.message_id),
+                                           message_id__in=[message.message_id for message in messages])
+        caching.set_many(messages)
+        return messages
     
     def accepted_types(self, serializer):
         return serializer.data['type'] == 'start-chatting' or serializer.data['type'] == 'text' or serializer.data['type'] == 'scan-data'
     
+    def validate(self, request, bot):
+        """
+        Verify Kik signature and serialize each message. Neither database nor broker are used.
+        
+        :returns: List of serialized messages and None or None and the response for the provider
+        """
+        signature = request.META.get('HTTP_X_KIK_SIGNATURE')
+        if signature:
+            signature.encode('utf-8')
+        if not bot._bot.verify_signature(signature, request.stream.body):
+            logger.debug("Kik Bot data %s not verified %s" % (request.data, signature))
+            return None, Response(status=403)
+        logger.debug("Kik Bot data %s verified" % (request.data))
+        messages = []
+        for kik_message in request.data['messages']:
+            serializer = KikMessageSerializer(data=kik_message)   
+            logger.debug("Kik message %s serialized" % (kik_message))
+            if not serializer.is_valid():
+                logger.error("Validation error: %s from kik message %s" % (serializer.errors, kik_message))
+                return None, Response(serializer.errors, status=status.HTTP_400_BAD_REQUEST)
+            if not self.accepted_types(serializer):
+                logger.warning("Not text message %s for bot %s" % (kik_message, bot.hook_id))
+                continue
+            messages.append(serializer.data)
+        if not messages:
+            return None, Response(status=status.HTTP_200_OK)
+        return messages, None
+    
+    def process(self, request, bot, messages):
+        """
+        Create all :class:`KikMessage <permabots.models.kik_api.KikMessage>` and :class:`KikUser <permabots.models.kik_api.KikUser>`
+        at once and delay processing to a group with a task for the messages of each chat. Messages already received are
+        not created again. Messages are not created with MICROBOT_EPHEMERAL_MESSAGES
+        """
+        try:
+            if ingestion.is_ephemeral():
+                if bot.enabled:
+                    logger.debug("Kik Bot %s attending request %s" % (bot, messages))
+                    group(handle_ephemeral_kik_messages.s(chat_messages, bot.id).set(**scheduling.task_options(chat_messages[0]['chatId']))
+                          for chat_messages in ingestion.split_by(messages, lambda message: message['chatId'])).apply_async()
+                else:
+                    logger.error("Messages %s ignored by disabled bot %s" % ([message['id'] for message in messages], bot))
+            else:
+                messages = self.create_messages(messages)
+                if bot.enabled:
+                    logger.debug("Kik Bot %s attending request %s" % (bot, messages))
+                    # Messages from the same chat are handled in order by one task
+                    group(handle_kik_messages.s([str(message.id) for message in chat_messages], bot.id).set(**scheduling.task_options(chat_messages[0].chat.id))
+                          for chat_messages in ingestion.split_by(messages, lambda message: message.chat.id)).apply_async()
+                else:
+                    logger.error("Messages %s ignored by disabled bot %s" % (messages, bot))
+        except:
+            exc_info = sys.exc_info()
+            traceback.print_exception(*exc_info)                
+            logger.error("Error processing %s for bot %s" % (request.data, bot.hook_id))
+            return Response(status=status.HTTP_500_INTERNAL_SERVER_ERROR)
+        return Response(status=status.HTTP_200_OK)
+    
     def post(self, request, hook_id):
         """
         Process Kik webhook:
             1. Get an enabled Kik bot
             2. Verify Kik signature
             3. Serialize each message
-            4. For each message create :class:`KikMessage <permabots.models.kik_api.KikMessage>` and :class:`KikUser <permabots.models.kik_api.KikUser>`
-            5. Delay each message processing to a task      
+            4. Create all :class:`KikMessage <permabots.models.kik_api.KikMessage>` and :class:`KikUser <permabots.models.kik_api.KikUser>` at once.
+               Skipped with MICROBOT_EPHEMERAL_MESSAGES
+            5. Delay processing to a group with a task for the messages of each chat      
             6. Response provider
         """
         try:
@@ -70,36 +105,7 @@ class KikHookView(APIView):
         except KikBot.DoesNotExist:
             logger.warning("Hook id %s not associated to a bot" % hook_id)
             return Response(status=status.HTTP_404_NOT_FOUND)
-        signature = request.META.get('HTTP_X_KIK_SIGNATURE')
-        if signature:
-            signature.encode('utf-8')
-        if not bot._bot.verify_signature(signature, request.stream.body):
-            logger.debug("Kik Bot data %s not verified %s" % (request.data, signature))
-            return Response(status=403)
-        logger.debug("Kik Bot data %s verified" % (request.data))
-        for kik_message in request.data['messages']:
-            serializer = KikMessageSerializer(data=kik_message)   
-            logger.debug("Kik message %s serialized" % (kik_message))
-            if serializer.is_valid():            
-                try:
-                    if not self.accepted_types(serializer):
-                        raise OnlyTextMessages
-                    message = self.create_message(serializer, bot)
-                    if bot.enabled:
-                        logger.debug("Kik Bot %s attending request %s" % (bot, kik_message))
-                        handle_message.delay(message.id, bot.id)
-                    else:
-                        logger.error("Message %s ignored by disabled bot %s" % (message, bot))
-                except OnlyTextMessages:
-                    logger.warning("Not text message %s for bot %s" % (kik_message, hook_id))
-                    return Response(status=status.HTTP_200_OK)
-                except:
-                    exc_info = sys.exc_info()
-                    traceback.print_exception(*exc_info)                
-                    logger.error("Error processing %s for bot %s" % (kik_message, hook_id))
-                    return Response(serializer.errors, status=status.HTTP_500_INTERNAL_SERVER_ERROR)
-                   
-            else:
-                logger.error("Validation error: %s from kik message %s" % (serializer.errors, kik_message))
-                return Response(serializer.errors, status=status.HTTP_400_BAD_REQUEST)
-        return Response(serializer.data, status=status.HTTP_200_OK)
\ No newline at end of file
+        messages, response = self.validate(request, bot)
+        if response:
+            return response
+        return self.process(request, bot, messages)
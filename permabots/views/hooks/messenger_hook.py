@@ -3,9 +3,12 @@ from permabots.models import MessengerBot, MessengerMessage
 from rest_framework.response import Response
 from rest_framework import status
 import logging
-from permabots.tasks import handle_messenger_message
+from permabots.tasks import handle_messenger_messages, handle_ephemeral_messenger_messages
+from celery import group
 from datetime import datetime
 from permabots import caching
+from permabots import ingestion
+from permabots import scheduling
 import sys
 import traceback
 from time import mktime
@@ -13,9 +16,6 @@ from six import iteritems
 
 logger = logging.getLogger(__name__)
 
-class OnlyTextMessages(Exception):
-    pass
-
 
 class Resource(object):
     def to_json(self):
@@ -179,6 +179,7 @@ class MessengerHookView(APIView):
     """
     View for Facebook Messenger webhook
     """
+    model = MessengerBot
     
     def get(self, request, hook_id):
         """
@@ -195,7 +196,7 @@ class MessengerHookView(APIView):
             return Response(int(request.query_params.get('hub.challenge')))
         return Response('Error, wrong validation token')
     
-    def create_message(self, webhook_message, bot):
+    def build_message(self, webhook_message, bot):
         if webhook_message.is_message:
             type = MessengerMessage.MESSAGE
             text = webhook_message.message.text
@@ -205,24 +206,87 @@ class MessengerHookView(APIView):
             text = None
             postback = webhook_message.message.payload            
         
-        message, _ = MessengerMessage.objects.get_or_create(bot=bot,
-                                                            sender=webhook_message.sender,
-                                                            recipient=webhook_message.recipient,
-                                                            timestamp=webhook_message.timestamp,
-                                                            type=type,
-                                                            text=text,
-                                                            postback=postback)
+        return MessengerMessage(bot=bot,
+                                sender=webhook_message.sender,
+                                recipient=webhook_message.recipient,
+                                timestamp=webhook_message.timestamp,
+                                type=type,
+                                text=text,
+                                postback=postback)
+    
+    def create_messages(self, webhook_messages, bot):
+        messages = [self.build_message(webhook_message, bot) for webhook_message in webhook_messages]
+        # Messenger messages have no id. Sender, timestamp and content identify them
+        messages = ingestion.save_messages(MessengerMessage, messages,
+                                           lambda message: (message.sender, ingestion.database_datetime(message.timestamp),
+                                                            message.type, message.text, message.postback),
+                                           bot=bot, sender__in=set(message.sender for message in messages),
+                                           timestamp__in=[message.timestamp for message in messages])
+        caching.set_many(messages)
+        return messages
+
+    def validate(self, request, bot):
+        """
+        Parse entries of the webhook skipping deliveries. Neither database nor broker are used.
         
-        caching.set(message)
-        return message
+        :returns: List of messages and None or None and the response for the provider
+        """
+        try:
+            webhook = Webhook.from_json(request.data)
+        except:
+            exc_info = sys.exc_info()
+            traceback.print_exception(*exc_info)                
+            logger.error("Error processing %s for bot %s" % (request.data, bot.hook_id))
+            return None, Response(status=status.HTTP_500_INTERNAL_SERVER_ERROR)
+        webhook_messages = []
+        for webhook_entry in webhook.entries:
+            for webhook_message in webhook_entry.messaging:
+                if webhook_message.is_delivery:
+                    logger.warning("Not text message %s for bot %s" % (webhook_message, bot.hook_id))
+                else:
+                    webhook_messages.append(webhook_message)
+        if not webhook_messages:
+            return None, Response(status=status.HTTP_200_OK)
+        return webhook_messages, None
+    
+    def process(self, request, bot, webhook_messages):
+        """
+        Create all :class:`MessengerMessage <permabots.models.messenger_api.MessengerMessage>` at once and delay processing
+        to a group with a task for the messages of each sender. Messages already received are not created again. Messages
+        are not created with MICROBOT_EPHEMERAL_MESSAGES
+        """
+        try:
+            if ingestion.is_ephemeral():
+                messages = [webhook_message.to_json() for webhook_message in webhook_messages]
+                if bot.enabled:
+                    logger.debug("Messenger Bot %s attending request %s" % (bot, messages))
+                    group(handle_ephemeral_messenger_messages.s(chat_messages, bot.id).set(**scheduling.task_options(chat_messages[0]['sender']['id']))
+                          for chat_messages in ingestion.split_by(messages, lambda message: message['sender']['id'])).apply_async()
+                else:
+                    logger.error("Messages %s ignored by disabled bot %s" % (messages, bot))
+            else:
+                messages = self.create_messages(webhook_messages, bot)
+                if bot.enabled:
+                    logger.debug("Messenger Bot %s attending request %s" % (bot, messages))
+                    # Messages from the same sender are handled in order by one task. Sender identifies the chat
+                    group(handle_messenger_messages.s([str(message.id) for message in chat_messages], bot.id).set(**scheduling.task_options(chat_messages[0].sender))
+                          for chat_messages in ingestion.split_by(messages, lambda message: message.sender)).apply_async()
+                else:
+                    logger.error("Messages %s ignored by disabled bot %s" % (messages, bot))
+        except:
+            exc_info = sys.exc_info()
+            traceback.print_exception(*exc_info)                
+            logger.error("Error processing %s for bot %s" % (request.data, bot.hook_id))
+            return Response(status=status.HTTP_500_INTERNAL_SERVER_ERROR)
+        return Response(status=status.HTTP_200_OK)
 
     def post(self, request, hook_id):
         """
         Process Messenger webhook.
             1. Get an enabled Messenger bot
-            3. For each message serialize
-            4. For each message create :class:`MessengerMessage <permabots.models.messenger_api.MessengerMessage>`
-            5. Delay processing of each message to a task      
+            3. Serialize all entries
+            4. Create all :class:`MessengerMessage <permabots.models.messenger_api.MessengerMessage>` at once. Skipped with MICROBOT_EPHEMERAL_MESSAGES
+            5. Delay processing to a group with a task for the messages of each sender      
             6. Response provider
         """
         try:
@@ -231,23 +295,7 @@ class MessengerHookView(APIView):
             logger.warning("Hook id %s not associated to a bot" % hook_id)
             return Response(status=status.HTTP_404_NOT_FOUND)
         logger.debug("Messenger Bot %s attending request %s" % (bot, request.data))
-        webhook = Webhook.from_json(request.data)
-        for webhook_entry in webhook.entries:
-            for webhook_message in webhook_entry.messaging:
-                try:
-                    if webhook_message.is_delivery:
-                        raise OnlyTextMessages
-                    message = self.create_message(webhook_message, bot)
-                    if bot.enabled:
-                        logger.debug("Messenger Bot %s attending request %s" % (bot, message))
-                        handle_messenger_message.delay(message.id, bot.id)
-                    else:
-                        logger.error("Message %s ignored by disabled bot %s" % (message, bot))
-                except OnlyTextMessages:
-                    logger.warning("Not text message %s for bot %s" % (message, hook_id))
-                except:
-                    exc_info = sys.exc_info()
-                    traceback.print_exception(*exc_info)                
-                    logger.error("Error processing %s for bot %s" % (webhook_message, hook_id))
-                    return Response(status=status.HTTP_500_INTERNAL_SERVER_ERROR)
-        return Response(status=status.HTTP_200_OK)        
\ No newline at end of file
+        webhook_messages, response = self.validate(request, bot)
+        if response:
+            return response
+        return self.process(request, bot, webhook_messages)
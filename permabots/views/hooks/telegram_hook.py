@@ -1,12 +1,14 @@
 from rest_framework.views import APIView
 from permabots.serializers import UpdateSerializer
-from permabots.models import TelegramBot, TelegramUser, TelegramChat, TelegramMessage, TelegramUpdate, TelegramCallbackQuery
+from permabots.models import TelegramBot, TelegramMessage, TelegramUpdate, TelegramCallbackQuery
 from rest_framework.response import Response
 from rest_framework import status
 import logging
-from permabots.tasks import handle_update
+from permabots.tasks import handle_update, handle_ephemeral_update
 from datetime import datetime
 from permabots import caching
+from permabots import ingestion
+from permabots import scheduling
 import sys
 import traceback
 
@@ -21,24 +23,25 @@ class TelegramHookView(APIView):
     """
     View for Telegram webhook
     """
+    model = TelegramBot
+    
+    def validate_update(self, serializer):
+        if 'message' in serializer.data:
+            if 'text' not in serializer.data['message']:
+                raise OnlyTextMessages
+        elif 'callback_query' not in serializer.data:
+            logger.error("Not valid message %s" % serializer.data)
+            raise OnlyTextMessages
     
     def create_update(self, serializer, bot):
+        users, chats = ingestion.upsert_telegram_users_and_chats(serializer.data)
         if 'message' in serializer.data: 
-            try:
-                user = caching.get_or_set(TelegramUser, serializer.data['message']['from']['id'])
-            except TelegramUser.DoesNotExist:
-                user, _ = TelegramUser.objects.get_or_create(**serializer.data['message']['from'])
-            try:
-                chat = caching.get_or_set(TelegramChat, serializer.data['message']['chat']['id'])
-            except TelegramChat.DoesNotExist:
-                chat, _ = TelegramChat.objects.get_or_create(**serializer.data['message']['chat'])
-            
             if 'text' not in serializer.data['message']:
                 raise OnlyTextMessages
             message, _ = TelegramMessage.objects.get_or_create(message_id=serializer.data['message']['message_id'],
-                                                               from_user=user,
+                                                               from_user=users[serializer.data['message']['from']['id']],
                                                                date=datetime.fromtimestamp(serializer.data['message']['date']),
-                                                               chat=chat,
+                                                               chat=chats[serializer.data['message']['chat']['id']],
                                                                text=serializer.data['message']['text'])
             update, _ = TelegramUpdate.objects.get_or_create(bot=bot,
                                                              update_id=serializer.data['update_id'],
@@ -47,30 +50,16 @@ class TelegramHookView(APIView):
         elif 'callback_query' in serializer.data:
             # Message may be not present if it is very old
             if 'message' in serializer.data['callback_query']:
-                try:
-                    user = caching.get_or_set(TelegramUser, serializer.data['callback_query']['message']['from']['id'])
-                except TelegramUser.DoesNotExist:
-                    user, _ = TelegramUser.objects.get_or_create(**serializer.data['callback_query']['message']['from'])
-                try:
-                    chat = caching.get_or_set(TelegramChat, serializer.data['callback_query']['message']['chat']['id'])
-                except TelegramChat.DoesNotExist:
-                    chat, _ = TelegramChat.objects.get_or_create(**serializer.data['callback_query']['message']['chat'])
-                
                 message, _ = TelegramMessage.objects.get_or_create(message_id=serializer.data['callback_query']['message']['message_id'],
-                                                                   from_user=user,
+                                                                   from_user=users[serializer.data['callback_query']['message']['from']['id']],
                                                                    date=datetime.fromtimestamp(serializer.data['callback_query']['message']['date']),
-                                                                   chat=chat,
+                                                                   chat=chats[serializer.data['callback_query']['message']['chat']['id']],
                                                                    text=serializer.data['callback_query']['message']['text'])
             else:
                 message = None
-            
-            try:
-                user = caching.get_or_set(TelegramUser, serializer.data['callback_query']['from']['id'])
-            except TelegramUser.DoesNotExist:
-                user, _ = TelegramUser.objects.get_or_create(**serializer.data['callback_query']['from'])
     
             callback_query, _ = TelegramCallbackQuery.objects.get_or_create(callback_id=serializer.data['callback_query']['id'],
-                                                                            from_user=user,
+                                                                            from_user=users[serializer.data['callback_query']['from']['id']],
                                                                             message=message,
                                                                             data=serializer.data['callback_query']['data'])
         
@@ -84,38 +73,69 @@ class TelegramHookView(APIView):
         caching.set(update)
         return update
     
-    def post(self, request, hook_id):
+    def validate(self, request, bot):
         """
-        Process Telegram webhook.
-            1. Serialize Telegram message
-            2. Get an enabled Telegram bot
-            3. Create :class:`Update <permabots.models.telegram_api.Update>`
-            5. Delay processing to a task      
-            6. Response provider
+        Serialize and validate Telegram update. Neither database nor broker are used.
+        
+        :returns: Serializer of the update and None or None and the response for the provider
         """
         serializer = UpdateSerializer(data=request.data)
-        if serializer.is_valid():
-            try:
-                bot = caching.get_or_set(TelegramBot, hook_id)
-            except TelegramBot.DoesNotExist:
-                logger.warning("Hook id %s not associated to an bot" % hook_id)
-                return Response(serializer.errors, status=status.HTTP_404_NOT_FOUND)
-            try:
+        if not serializer.is_valid():
+            logger.error("Validation error: %s from message %s" % (serializer.errors, request.data))
+            return None, Response(serializer.errors, status=status.HTTP_400_BAD_REQUEST)
+        try:
+            self.validate_update(serializer)
+        except OnlyTextMessages:
+            logger.warning("Not text message %s for bot %s" % (request.data, bot.hook_id))
+            return None, Response(status=status.HTTP_200_OK)
+        return serializer, None
+    
+    def process(self, request, bot, serializer):
+        """
+        Create :class:`Update <permabots.models.telegram_api.Update>` and delay its processing to a task.
+        Update is not created with MICROBOT_EPHEMERAL_MESSAGES
+        """
+        try:
+            if ingestion.is_ephemeral():
+                if bot.enabled:
+                    logger.debug("Telegram Bot %s attending request %s" % (bot.token, request.data))
+                    handle_ephemeral_update.apply_async((serializer.data, bot.id),
+                                                        **scheduling.task_options(scheduling.telegram_chat_id(serializer.data)))
+                else:
+                    logger.error("Update %s ignored by disabled bot %s" % (serializer.data['update_id'], bot.token))
+            else:
                 update = self.create_update(serializer, bot)
                 if bot.enabled:
                     logger.debug("Telegram Bot %s attending request %s" % (bot.token, request.data))
-                    handle_update.delay(update.id, bot.id)
+                    handle_update.apply_async((update.id, bot.id),
+                                              **scheduling.task_options(scheduling.telegram_chat_id(serializer.data)))
                 else:
                     logger.error("Update %s ignored by disabled bot %s" % (update, bot.token))
-            except OnlyTextMessages:
-                logger.warning("Not text message %s for bot %s" % (request.data, hook_id))
-                return Response(status=status.HTTP_200_OK)
-            except:
-                exc_info = sys.exc_info()
-                traceback.print_exception(*exc_info)                
-                logger.error("Error processing %s for bot %s" % (request.data, hook_id))
-                return Response(serializer.errors, status=status.HTTP_500_INTERNAL_SERVER_ERROR)
-            else:
-                return Response(serializer.data, status=status.HTTP_200_OK)
-        logger.error("Validation error: %s from message %s" % (serializer.errors, request.data))
-        return Response(serializer.errors, status=status.HTTP_400_BAD_REQUEST)
\ No newline at end of file
+        except OnlyTextMessages:
+            logger.warning("Not text message %s for bot %s" % (request.data, bot.hook_id))
+            return Response(status=status.HTTP_200_OK)
+        except:
+            exc_info = sys.exc_info()
+            traceback.print_exception(*exc_info)                
+            logger.error("Error processing %s for bot %s" % (request.data, bot.hook_id))
+            return Response(serializer.errors, status=status.HTTP_500_INTERNAL_SERVER_ERROR)
+        return Response(serializer.data, status=status.HTTP_200_OK)
+    
+    def post(self, request, hook_id):
+        """
+        Process Telegram webhook.
+            1. Get an enabled Telegram bot
+            2. Serialize Telegram message
+            3. Create :class:`Update <permabots.models.telegram_api.Update>`. Skipped with MICROBOT_EPHEMERAL_MESSAGES
+            5. Delay processing to a task      
+            6. Response provider
+        """
+        try:
+            bot = caching.get_or_set(TelegramBot, hook_id)
+        except TelegramBot.DoesNotExist:
+            logger.warning("Hook id %s not associated to an bot" % hook_id)
+            return Response(status=status.HTTP_404_NOT_FOUND)
+        serializer, response = self.validate(request, bot)
+        if response:
+            return response
+        return self.process(request, bot, serializer)
@@ -1,11 +1,23 @@
 #!/usr/bin/env python
 # -*- coding: utf-8 -*-
-from permabots.models import Bot, TelegramBot, KikBot, MessengerBot
-from permabots.test import testcases
+from permabots.models import Bot, TelegramBot, KikBot, MessengerBot, MessengerMessage, KikMessage
+from permabots.test import testcases, factories
 from django.core.urlresolvers import reverse
 from rest_framework import status
 from django.core.exceptions import ValidationError
 from django.test import override_settings
+from permabots import connections
+from permabots import scheduling
+from permabots import tasks
+from permabots import throttling
+from django.core.cache import cache
+from telegram.error import RetryAfter, Unauthorized
+from kik import KikError
+from time import mktime
+import pickle
+import json
+import requests
+import uuid
 try:
     from unittest import mock
 except ImportError:
@@ -46,11 +58,20 @@ class TestTelegramBot(testcases.BaseTestBot):
     def test_bot_disabled(self):
         self.bot.telegram_bot.enabled = False
         self.bot.telegram_bot.save()
-        with mock.patch("permabots.tasks.handle_update.delay", callable=mock.MagicMock()) as mock_send:
+        with mock.patch("permabots.tasks.handle_update.apply_async", callable=mock.MagicMock()) as mock_send:
             response = self.client.post(self.telegram_webhook_url, self.telegram_update.to_json(), **self.kwargs)
             self.assertEqual(status.HTTP_200_OK, response.status_code)
             self.assertEqual(0, mock_send.call_count)
         
+    @override_settings(MICROBOT_CHAT_QUEUES=4)
+    def test_update_routed_to_chat_queue(self):
+        with mock.patch("permabots.tasks.handle_update.apply_async", callable=mock.MagicMock()) as mock_apply:
+            response = self.client.post(self.telegram_webhook_url, self.telegram_update.to_json(), **self.kwargs)
+            self.assertEqual(status.HTTP_200_OK, response.status_code)
+            args, kwargs = mock_apply.call_args
+            self.assertEqual(scheduling.get_queue(self.telegram_update.message.chat.id), kwargs['queue'])
+            self.assertIn(kwargs['queue'], ['permabots.chat.%d' % partition for partition in range(4)])
+        
     def test_not_valid_update(self):
         del self.telegram_update.message
         response = self.client.post(self.telegram_webhook_url, self.telegram_update.to_json(), **self.kwargs)
@@ -82,9 +103,77 @@ class TestTelegramBot(testcases.BaseTestBot):
             self.assertEqual(1, mock_setwebhook.call_count)
             self.assertIn('manualdomain.com', kwargs['webhook_url'])
             
+    def test_telegram_connections_shared(self):
+        other_bot = TelegramBot.objects.get(pk=self.bot.telegram_bot.pk)
+        self.assertIs(connections.get_telegram_request(), self.bot.telegram_bot._bot._request)
+        self.assertIs(self.bot.telegram_bot._bot._request, other_bot._bot._request)
+        
+    def test_telegram_client_reused(self):
+        telegram_bot = TelegramBot.objects.get(pk=self.bot.telegram_bot.pk)
+        other_bot = TelegramBot.objects.get(pk=self.bot.telegram_bot.pk)
+        self.assertIs(telegram_bot._bot, other_bot._bot)
+        unpickled_bot = pickle.loads(pickle.dumps(other_bot))
+        self.assertIs(other_bot._bot, unpickled_bot._bot)
+        
+    def test_telegram_unpickled_with_invalid_token(self):
+        telegram_bot = TelegramBot.objects.get(pk=self.bot.telegram_bot.pk)
+        telegram_bot.token = 'invalid'
+        unpickled_bot = pickle.loads(pickle.dumps(telegram_bot))
+        self.assertIsNone(unpickled_bot._bot)
+        
+    def test_telegram_client_deleted_when_bot_changes(self):
+        client = TelegramBot.objects.get(pk=self.bot.telegram_bot.pk)._bot
+        with mock.patch("telegram.bot.Bot.set_webhook", callable=mock.MagicMock()):
+            self.bot.telegram_bot.save()
+        other_bot = TelegramBot.objects.get(pk=self.bot.telegram_bot.pk)
+        self.assertIsNot(client, other_bot._bot)
+        
+    def test_telegram_retry_after(self):
+        with mock.patch("telegram.bot.Bot.send_message", callable=mock.MagicMock(),
+                        side_effect=[None, RetryAfter(2)]) as mock_send:
+            with self.assertRaises(throttling.Throttled) as context:
+                self.bot.telegram_bot.send_message(101, 'first\\nsecond', None)
+            self.assertEqual((2, 1), (context.exception.countdown, context.exception.sent))
+            self.assertEqual(2, mock_send.call_count)
+        with mock.patch("telegram.bot.Bot.send_message", callable=mock.MagicMock()) as mock_send:
+            self.assertRaises(throttling.Throttled, self.bot.telegram_bot.send_message, 101, 'other', None)
+            self.assertEqual(0, mock_send.call_count)
+        
+    def test_telegram_retry_after_delivered_from_chunk(self):
+        with mock.patch("telegram.bot.Bot.send_message", callable=mock.MagicMock(),
+                        side_effect=[None, RetryAfter(2), None, None]) as mock_send:
+            retry = tasks.deliver_message.retry
+            
+            def retry_after_countdown(**kwargs):
+                # Eager retries run at once ignoring countdown. Bot is not paused anymore after it
+                cache.clear()
+                return retry(**kwargs)
+            
+            with mock.patch.object(tasks.deliver_message, 'retry', side_effect=retry_after_countdown) as mock_retry:
+                tasks.deliver_message.apply(('telegram', self.bot.telegram_bot.pk, 101, [('first\\nsecond', None, {}),
+                                                                                          ('third', None, {})]))
+                self.assertEqual(1, mock_retry.call_count)
+                self.assertEqual(2, mock_retry.call_args[1]['countdown'])
+            self.assertEqual(['first', 'second', 'second', 'third'], [kwargs['text'] for args, kwargs in mock_send.call_args_list])
+            
+    def test_telegram_blocked_user_not_sent_again(self):
+        with mock.patch("telegram.bot.Bot.send_message", callable=mock.MagicMock(),
+                        side_effect=Unauthorized("Forbidden: bot was blocked by the user")):
+            with self.assertRaises(throttling.SendError) as context:
+                self.bot.telegram_bot.send_message(101, 'first', None)
+            self.assertIsNone(throttling.get_retry(context.exception, 0))
+            
+    @override_settings(MICROBOT_RATE_LIMITS={'telegram': 2}, MICROBOT_CHAT_RATE_LIMITS={'telegram': {'private': (1, 60)}})
+    def test_telegram_chat_throttled_not_counted_for_bot(self):
+        with mock.patch("telegram.bot.Bot.send_message", callable=mock.MagicMock()) as mock_send:
+            self.bot.telegram_bot.send_message(101, 'first', None)
+            self.assertRaises(throttling.Throttled, self.bot.telegram_bot.send_message, 101, 'second', None)
+            self.bot.telegram_bot.send_message(102, 'other', None)
+            self.assertEqual(['first', 'other'], [kwargs['text'] for args, kwargs in mock_send.call_args_list])
+            
             
 class TestKikBot(testcases.KikTestBot):
-    set_webhook_call = "kik.api.KikApi.set_configuration"
+    set_webhook_call = "permabots.connections.KikClient.set_configuration"
     
     def test_enable_webhook(self):
         self.assertTrue(self.bot.kik_bot.enabled)
@@ -114,7 +203,7 @@ class TestKikBot(testcases.KikTestBot):
         self.bot.kik_bot.save()
         with mock.patch('kik.api.KikApi.verify_signature', callable=mock.MagicMock()) as mock_verify:
             mock_verify.return_value = True
-            with mock.patch("permabots.tasks.handle_message.delay", callable=mock.MagicMock()) as mock_send:
+            with mock.patch("permabots.tasks.handle_kik_messages.s", callable=mock.MagicMock()) as mock_send:
                 response = self.client.post(self.kik_webhook_url, self.to_send(self.kik_messages), **self.kwargs)
                 self.assertEqual(status.HTTP_200_OK, response.status_code)
                 self.assertEqual(0, mock_send.call_count)
@@ -136,9 +225,97 @@ class TestKikBot(testcases.KikTestBot):
             self.assertEqual(1, mock_setwebhook.call_count)
             self.assertIn('manualdomain.com', args[0].webhook)    
             
+    def test_kik_connections_shared(self):
+        with mock.patch.object(connections.get_session(), 'post', callable=mock.MagicMock()) as mock_post:
+            mock_post.return_value.status_code = 200
+            self.bot.kik_bot._bot.send_messages([])
+            self.assertEqual(1, mock_post.call_count)
+            self.assertIn('/v1/message', mock_post.call_args[0][0])
+            
+    def test_messages_from_same_chat_in_one_task(self):
+        other_message = factories.KikTextMessageLibFactory(id=str(uuid.uuid4()))
+        last_message = factories.KikTextMessageLibFactory(id=str(uuid.uuid4()), chat_id=self.kik_message.chat_id,
+                                                          from_user=self.kik_message.from_user)
+        messages = [self.kik_message, other_message, last_message]
+        for message in messages:
+            message.timestamp = int(mktime(message.timestamp.timetuple()))
+            message.id = str(message.id)
+        with mock.patch('kik.api.KikApi.verify_signature', callable=mock.MagicMock()) as mock_verify:
+            mock_verify.return_value = True
+            with mock.patch("permabots.views.hooks.kik_hook.group", callable=mock.MagicMock()) as mock_group:
+                with mock.patch("permabots.tasks.handle_kik_messages.s", callable=mock.MagicMock()) as mock_task:
+                    response = self.client.post(self.kik_webhook_url, json.dumps({'messages': [message.to_json() for message in messages]}),
+                                                **self.kwargs)
+                    self.assertEqual(status.HTTP_200_OK, response.status_code)
+                    self.assertEqual(1, mock_group.call_count)
+                    list(mock_group.call_args[0][0])
+                    self.assertEqual(2, mock_task.call_count)
+                    message_ids, bot_id = mock_task.call_args_list[0][0]
+                    self.assertEqual([KikMessage.objects.get(id=message_id).body for message_id in message_ids],
+                                     [self.kik_message.body, last_message.body])
+        self.assertEqual(3, KikMessage.objects.count())
+        
+    def test_redelivered_messages_not_created_again(self):
+        other_message = factories.KikTextMessageLibFactory(id=str(uuid.uuid4()))
+        messages = [self.kik_message, other_message]
+        for message in messages:
+            message.timestamp = int(mktime(message.timestamp.timetuple()))
+            message.id = str(message.id)
+        data = json.dumps({'messages': [message.to_json() for message in messages]})
+        with mock.patch('kik.api.KikApi.verify_signature', callable=mock.MagicMock()) as mock_verify:
+            mock_verify.return_value = True
+            with mock.patch("permabots.views.hooks.kik_hook.group", callable=mock.MagicMock()):
+                with mock.patch("permabots.tasks.handle_kik_messages.s", callable=mock.MagicMock()):
+                    for delivery in range(2):
+                        response = self.client.post(self.kik_webhook_url, data, **self.kwargs)
+                        self.assertEqual(status.HTTP_200_OK, response.status_code)
+        self.assertEqual(2, KikMessage.objects.count())
+        
+    def test_delivery_retried_when_fails(self):
+        with mock.patch(self.send_message_to_patch, callable=mock.MagicMock(), side_effect=[requests.ConnectionError("Unavailable"), None]) as mock_send:
+            with mock.patch.object(tasks.deliver_message, 'retry', wraps=tasks.deliver_message.retry) as mock_retry:
+                result = tasks.deliver_message.apply(('kik', self.bot.kik_bot.pk, 'chat', [('first', None, {'user': 'user1'})]))
+                self.assertTrue(result.successful())
+                self.assertEqual(1, mock_retry.call_count)
+                self.assertEqual(throttling.DEFAULT_SEND_BACKOFF, mock_retry.call_args[1]['countdown'])
+            self.assertEqual(2, mock_send.call_count)
+            self.assertEqual('first', mock_send.call_args[0][0][0].body)
+            
+    @override_settings(MICROBOT_SEND_RETRIES=1)
+    def test_delivery_not_retried_after_send_retries(self):
+        with mock.patch(self.send_message_to_patch, callable=mock.MagicMock(), side_effect=requests.ConnectionError("Unavailable")) as mock_send:
+            tasks.deliver_message.apply(('kik', self.bot.kik_bot.pk, 'chat', [('first', None, {'user': 'user1'}),
+                                                                              ('second', None, {'user': 'user1'})]))
+            self.assertEqual(['first', 'first', 'second', 'second'], [args[0][0].body for args, kwargs in mock_send.call_args_list])
+            
+    def test_delivery_not_retried_when_rejected(self):
+        error = connections.provider_error(KikError("Bad request"), mock.MagicMock(status_code=400))
+        with mock.patch(self.send_message_to_patch, callable=mock.MagicMock(), side_effect=[error, None]) as mock_send:
+            with mock.patch.object(tasks.deliver_message, 'retry', wraps=tasks.deliver_message.retry) as mock_retry:
+                tasks.deliver_message.apply(('kik', self.bot.kik_bot.pk, 'chat', [('first', None, {'user': 'user1'}),
+                                                                                  ('second', None, {'user': 'user1'})]))
+                self.assertEqual(0, mock_retry.call_count)
+            self.assertEqual(['first', 'second'], [args[0][0].body for args, kwargs in mock_send.call_args_list])
+            
+    @override_settings(MICROBOT_DELIVERY_QUEUE='permabots.delivery')
+    def test_responses_of_chat_delivered_by_one_task(self):
+        messages = [mock.MagicMock(chat_id='chat1', body='first'), mock.MagicMock(chat_id='chat2', body='other'),
+                    mock.MagicMock(chat_id='chat1', body='second')]
+        
+        def handle_message(bot, message, bot_service, outbox):
+            outbox.append((message.chat_id, message.body, None, {'user': 'user1'}))
+            
+        with mock.patch("permabots.ingestion.build_kik_messages", callable=mock.MagicMock(), return_value=messages):
+            with mock.patch.object(Bot, 'handle_message', autospec=True, side_effect=handle_message):
+                with mock.patch('permabots.tasks.deliver_message.apply_async', callable=mock.MagicMock()) as mock_apply:
+                    tasks.handle_ephemeral_kik_messages([], self.bot.kik_bot.pk)
+                    self.assertEqual([('chat1', ['first', 'second']), ('chat2', ['other'])],
+                                     [(args[0][2], [response[0] for response in args[0][3]]) for args, kwargs in mock_apply.call_args_list])
+                    self.assertEqual('permabots.delivery', mock_apply.call_args[1]['queue'])
+            
             
 class TestMessengerBot(testcases.MessengerTestBot):
-    set_webhook_call = "messengerbot.MessengerClient.subscribe_app"
+    set_webhook_call = "permabots.connections.MessengerBotClient.subscribe_app"
     
     def test_subscribe(self):
         self.assertTrue(self.bot.messenger_bot.enabled)
@@ -156,11 +333,50 @@ class TestMessengerBot(testcases.MessengerTestBot):
     def test_bot_disabled(self):
         self.bot.messenger_bot.enabled = False
         self.bot.messenger_bot.save()
-        with mock.patch("permabots.tasks.handle_messenger_message.delay", callable=mock.MagicMock()) as mock_send:
+        with mock.patch("permabots.tasks.handle_messenger_messages.s", callable=mock.MagicMock()) as mock_send:
             response = self.client.post(self.messenger_webhook_url, self.to_send(self.messenger_webhook_message), **self.kwargs)
             self.assertEqual(status.HTTP_200_OK, response.status_code)
             self.assertEqual(0, mock_send.call_count)
             
+    def test_messages_from_same_sender_in_one_task(self):
+        other_message = factories.MessengerMessagingFactory()
+        last_message = factories.MessengerMessagingFactory(sender=self.messenger_text_message.sender)
+        self.messenger_entry.messaging = [self.messenger_text_message, other_message, last_message]
+        with mock.patch("permabots.views.hooks.messenger_hook.group", callable=mock.MagicMock()) as mock_group:
+            with mock.patch("permabots.tasks.handle_messenger_messages.s", callable=mock.MagicMock()) as mock_task:
+                response = self.client.post(self.messenger_webhook_url, self.to_send(self.messenger_webhook_message), **self.kwargs)
+                self.assertEqual(status.HTTP_200_OK, response.status_code)
+                self.assertEqual(1, mock_group.call_count)
+                list(mock_group.call_args[0][0])
+                self.assertEqual(2, mock_task.call_count)
+                message_ids, bot_id = mock_task.call_args_list[0][0]
+                self.assertEqual([MessengerMessage.objects.get(id=message_id).text for message_id in message_ids],
+                                 [self.messenger_text_message.message.text, last_message.message.text])
+        self.assertEqual(3, MessengerMessage.objects.count())
+        
+    def test_redelivered_messages_not_created_again(self):
+        other_message = factories.MessengerMessagingFactory()
+        self.messenger_entry.messaging = [self.messenger_text_message, other_message]
+        data = self.to_send(self.messenger_webhook_message)
+        with mock.patch("permabots.views.hooks.messenger_hook.group", callable=mock.MagicMock()) as mock_group:
+            with mock.patch("permabots.tasks.handle_messenger_messages.s", callable=mock.MagicMock()) as mock_task:
+                for delivery in range(2):
+                    response = self.client.post(self.messenger_webhook_url, data, **self.kwargs)
+                    self.assertEqual(status.HTTP_200_OK, response.status_code)
+                    list(mock_group.call_args[0][0])
+                # Messages saved the first time are handled again
+                self.assertEqual(mock_task.call_args_list[:2], mock_task.call_args_list[2:])
+        self.assertEqual(2, MessengerMessage.objects.count())
+            
+    def test_ephemeral_message_not_built(self):
+        message = mock.MagicMock()
+        with mock.patch("permabots.ingestion.build_messenger_message", callable=mock.MagicMock()) as mock_build:
+            mock_build.side_effect = [Exception("Not valid"), message]
+            with mock.patch("permabots.tasks._handle_message", callable=mock.MagicMock()) as mock_handle:
+                tasks.handle_ephemeral_messenger_messages([{'sender': {'id': 'a'}}, {'sender': {'id': 'a'}}], self.bot.messenger_bot.id)
+                self.assertEqual(2, mock_build.call_count)
+                mock_handle.assert_called_once_with(self.bot.messenger_bot, message, [])
+            
     def test_bot_verify_ok(self):
         response = self.client.get(self.messenger_webhook_url, {'hub.mode': 'subscribe', 'hub.challenge': 12345, 'hub.verify_token': self.bot.messenger_bot.id})
         self.assertEqual(status.HTTP_200_OK, response.status_code)
@@ -1,21 +1,39 @@
 #!/usr/bin/env python
 # -*- coding: utf-8 -*-
-from permabots.models import Request, EnvironmentVar, TelegramChatState, Handler, KikChatState, MessengerChatState
+from permabots.models import Request, EnvironmentVar, TelegramChatState, Handler, KikChatState, MessengerChatState, \
+    TelegramUpdate, TelegramMessage, TelegramChat, TelegramUser
 from tests.models import Author, Book
 from permabots.test import factories, testcases
-from django.test import LiveServerTestCase
+from permabots import routing
+from permabots import rendering
+from permabots import chat_states
+from permabots import contexts
+from permabots import keyboards
+from permabots import environment
+from permabots import upstreams
+from permabots.tasks import deliver_message
+from django.test import TestCase, LiveServerTestCase, override_settings
 from django.conf import settings
 from rest_framework.authtoken.models import Token
 from django.apps import apps
+from django.db.models import F
 import json
+import requests
 from rest_framework import status
-from unittest import skip
+from unittest import skip, skipIf
 from messengerbot.elements import PostbackButton
 import datetime
+import sys
 try:
     from unittest import mock
 except ImportError:
     import mock  # noqa
+try:
+    import asyncio
+    import httpx
+    from permabots import async_upstreams
+except (ImportError, SyntaxError):
+    async_upstreams = None
 
 ModelUser = apps.get_model(getattr(settings, 'AUTH_USER_MODEL', 'auth.User'))
 
@@ -59,6 +77,44 @@ class TestHandler(testcases.TelegramTestBot):
         
         self._test_message(self.author_get, no_handler=True)
         
+    def test_handler_response_not_sent_when_chat_state_changes(self):
+        self.state = factories.StateFactory(bot=self.bot,
+                                            name="state1")
+        self.state_target = factories.StateFactory(bot=self.bot,
+                                                   name="state2")
+        self.other_state = factories.StateFactory(bot=self.bot,
+                                                  name="state3")
+        self.handler = factories.HandlerFactory(bot=self.bot,
+                                                pattern="/authors",
+                                                request=None,
+                                                response__text_template="<b>author1</b>",
+                                                response__keyboard_template="",
+                                                target_state=self.state_target)
+        self.handler.source_states.add(self.state)
+        self.user = factories.TelegramUserAPIFactory(id=self.telegram_update.message.from_user.id,
+                                                     username=self.telegram_update.message.from_user.username,
+                                                     first_name=self.telegram_update.message.from_user.first_name,
+                                                     last_name=self.telegram_update.message.from_user.last_name)
+        self.chat = factories.TelegramChatAPIFactory(id=self.telegram_update.message.chat.id,
+                                                     type=self.telegram_update.message.chat.type, 
+                                                     title=self.telegram_update.message.chat.title,
+                                                     username=self.telegram_update.message.chat.username,
+                                                     first_name=self.telegram_update.message.chat.first_name,
+                                                     last_name=self.telegram_update.message.chat.last_name)
+        self.chat_state = factories.TelegramChatStateFactory(chat=self.chat,
+                                                             state=self.state,
+                                                             user=self.user)
+        process = Handler.process
+        
+        def process_while_chat_state_changes(handler, bot, **kwargs):
+            # Other message of the chat moves it to other state meanwhile
+            TelegramChatState.objects.filter(pk=self.chat_state.pk).update(state=self.other_state, version=F('version') + 1)
+            return process(handler, bot, **kwargs)
+        
+        with mock.patch.object(Handler, 'process', autospec=True, side_effect=process_while_chat_state_changes):
+            self._test_message(self.author_get, no_handler=True)
+        self.assertEqual(self.other_state, TelegramChatState.objects.get(pk=self.chat_state.pk).state)
+        
     def test_handler_in_other_state_when_no_chat_state(self):
         self.state = factories.StateFactory(bot=self.bot,
                                             name="state1")
@@ -84,12 +140,252 @@ class TestHandler(testcases.TelegramTestBot):
         self.assertEqual(Handler.objects.all()[0], self.handler2)
         self.assertEqual(Handler.objects.all()[1], self.handler1)
         
+    def test_router_rebuilt_when_handler_changes(self):
+        self.handler = factories.HandlerFactory(bot=self.bot,
+                                                pattern="/authors")
+        router = routing.get_router(self.bot)
+        self.assertIs(router, routing.get_router(self.bot))
+        self.assertEqual(router.resolve("/authors")[0], self.handler)
+        self.handler.pattern = "/books"
+        self.handler.save()
+        router = routing.get_router(self.bot)
+        self.assertEqual(None, router.resolve("/authors"))
+        self.assertEqual(router.resolve("/books")[0], self.handler)
+        
+    def test_router_rebuilt_when_response_changes(self):
+        self.handler = factories.HandlerFactory(bot=self.bot,
+                                                pattern="/authors")
+        routing.get_router(self.bot)
+        response = self.handler.response
+        response.text_template = "<b>changed</b>"
+        response.save()
+        self.assertEqual("<b>changed</b>", routing.get_router(self.bot).resolve("/authors")[0].response.text_template)
+        
+    def test_router_by_source_state(self):
+        self.state = factories.StateFactory(bot=self.bot,
+                                            name="state1")
+        self.handler = factories.HandlerFactory(bot=self.bot,
+                                                pattern="/authors@(?P<id>\d+)")
+        self.handler_in_state = factories.HandlerFactory(bot=self.bot,
+                                                         pattern="/books")
+        self.handler_in_state.source_states.add(self.state)
+        router = routing.get_router(self.bot)
+        self.assertEqual(None, router.resolve("/books"))
+        self.assertEqual(router.resolve("/books", self.state.id)[0], self.handler_in_state)
+        self.assertEqual(router.resolve("/authors@1", self.state.id), (self.handler, {'id': '1'}))
+        
+    def test_handler_index_by_source_state(self):
+        self.state = factories.StateFactory(bot=self.bot,
+                                            name="state1")
+        self.handler = factories.HandlerFactory(bot=self.bot,
+                                                pattern="/authors",
+                                                priority=1)
+        self.handler_in_state = factories.HandlerFactory(bot=self.bot,
+                                                         pattern="/books",
+                                                         priority=2)
+        self.handler_in_state.source_states.add(self.state)
+        factories.HandlerFactory(bot=self.bot, enabled=False)
+        with self.assertNumQueries(2):
+            index = routing.get_or_set_index(self.bot)
+        self.assertEqual(index[None], [self.handler])
+        self.assertEqual(index[self.state.id], [self.handler_in_state, self.handler])
+        with self.assertNumQueries(0):
+            routing.get_or_set_index(self.bot)
+        
+    def test_template_compiled_once(self):
+        template = rendering.get_template("<b>{{pattern.id}}</b>")
+        self.assertIs(template, rendering.get_template("<b>{{pattern.id}}</b>"))
+        
+    @override_settings(MICROBOT_TEMPLATE_CACHE_SIZE=1)
+    def test_least_recently_used_template_discarded(self):
+        template = rendering.get_template("<b>{{pattern.id}}</b>")
+        rendering.get_template("<b>{{pattern.name}}</b>")
+        self.assertIsNot(template, rendering.get_template("<b>{{pattern.id}}</b>"))
+        
+    def test_template_variables(self):
+        self.assertEqual(frozenset(['env', 'message']), rendering.get_variables("{{env.name}}", None, "{% for b in message.text %}{{b}}{% endfor %}"))
+
+    def test_unused_context_not_built(self):
+        self.handler = factories.HandlerFactory(bot=self.bot,
+                                                pattern="/authors",
+                                                request=None,
+                                                response__text_template="<b>author1</b>",
+                                                response__keyboard_template="")
+        with mock.patch('permabots.models.telegram_api.Update.to_dict', callable=mock.MagicMock()) as mock_to_dict:
+            self._test_message(self.author_get)
+            self.assertEqual(0, mock_to_dict.call_count)
+        
+    def test_request_template_variables(self):
+        request = factories.RequestFactory(url_template="https://api.github.com/users/{{pattern.user}}",
+                                           method=Request.POST,
+                                           data='{"text": "{{message.text}}"}')
+        factories.HeaderParamFactory(request=request, key='Authorization', value_template='Token {{env.token}}')
+        self.assertEqual(frozenset(['pattern', 'message', 'env']), Request.objects.get(pk=request.pk).template_variables())
+        
+    def test_unused_context_not_built_with_request(self):
+        self.handler = factories.HandlerFactory(bot=self.bot,
+                                                pattern="/authors",
+                                                response__text_template="<b>author1</b>",
+                                                response__keyboard_template="")
+        with mock.patch('permabots.upstreams.request', callable=mock.MagicMock()) as mock_request:
+            mock_request.return_value.status_code = 200
+            with mock.patch('permabots.models.telegram_api.Update.to_dict', callable=mock.MagicMock()) as mock_to_dict:
+                self._test_message(self.author_get)
+                self.assertEqual(0, mock_to_dict.call_count)
+            self.assertEqual(1, mock_request.call_count)
+        
+    def test_constant_response(self):
+        self.assertTrue(rendering.is_constant("<b>author1</b>", None))
+        self.assertFalse(rendering.is_constant("<b>author1</b>", "{{ env.keyboard }}"))
+        keyboards.clear()
+        self.handler = factories.HandlerFactory(bot=self.bot,
+                                                pattern="/authors",
+                                                request=None,
+                                                response__text_template="<b>author1</b>",
+                                                response__keyboard_template="")
+        with mock.patch('permabots.models.bot.TelegramBot.build_keyboard', callable=mock.MagicMock(), return_value='') as mock_build:
+            self._test_message(self.author_get)
+            self.telegram_update.update_id += 1
+            self._test_message(self.author_get, number=2)
+            self.assertEqual(1, mock_build.call_count)
+        
+    def test_keyboard_parsed(self):
+        self.assertEqual(['menu', 'help', 'info'], keyboards.parse("[['menu', 'help'], ['info']]"))
+        self.assertEqual([('web', 'http://example.com'), 'menu'], keyboards.parse("[[('web', 'http://example.com')], ['menu']]"))
+        keyboard = keyboards.get_or_build(self.bot.kik_bot, "[['menu']]")
+        self.assertIs(keyboard, keyboards.get_or_build(self.bot.kik_bot, "[['menu']]"))
+        
+    def test_environment_reloaded_when_env_vars_change(self):
+        EnvironmentVar.objects.create(bot=self.bot, key="shop", value="books")
+        env = environment.get_env(self.bot)
+        self.assertEqual({'shop': 'books'}, dict(env))
+        self.assertIs(env, environment.get_env(self.bot))
+        with self.assertRaises(TypeError):
+            env['shop'] = 'other'
+        EnvironmentVar.objects.create(bot=self.bot, key="city", value="Madrid")
+        self.assertEqual({'shop': 'books', 'city': 'Madrid'}, dict(environment.get_env(self.bot)))
+        
+    @override_settings(MICROBOT_DELIVERY_QUEUE='permabots.delivery')
+    def test_response_delivered_by_delivery_queue(self):
+        self.handler = factories.HandlerFactory(bot=self.bot,
+                                                pattern="/authors",
+                                                request=None,
+                                                response__text_template="<b>author1</b>",
+                                                response__keyboard_template="")
+        with mock.patch('permabots.tasks.deliver_message.apply_async', callable=mock.MagicMock()) as mock_apply:
+            self._test_message(self.author_get, no_handler=True)
+            self.assertEqual(1, mock_apply.call_count)
+            args, kwargs = mock_apply.call_args
+            self.assertEqual('permabots.delivery', kwargs['queue'])
+        with mock.patch(self.send_message_to_patch, callable=mock.MagicMock()) as mock_send:
+            deliver_message.apply(args[0])
+            self.assertBotResponse(mock_send, self.author_get)
+            self.assertEqual(self.telegram_update.message.message_id, mock_send.call_args[1]['reply_to_message_id'])
+        
     def test_handler_request_no_cascade(self):
         self.handler = factories.HandlerFactory(bot=self.bot)
         self.assertEqual(Handler.objects.count(), 1)
         Request.objects.all().delete()
-        self.assertEqual(Handler.objects.count(), 1)        
+        self.assertEqual(Handler.objects.count(), 1)
+
+    def test_chat_state_concurrent_update(self):
+        state = factories.StateFactory(bot=self.bot, name="state1")
+        state_target = factories.StateFactory(bot=self.bot, name="state2")
+        chat_state = factories.TelegramChatStateFactory(state=state)
+        stale_chat_state = TelegramChatState.objects.get(pk=chat_state.pk)
+        self.assertTrue(chat_state.compare_and_set(state_target, 'state1', {'first': 1}, self.bot))
+        self.assertTrue(chat_state.compare_and_set(state, 'state2', {'second': 2}, self.bot))
+        # Retried as the chat is in the state it was loaded with again
+        self.assertTrue(stale_chat_state.compare_and_set(state_target, 'state1_again', {'third': 3}, self.bot))
+        chat_state = TelegramChatState.objects.get(pk=chat_state.pk)
+        self.assertEqual(3, chat_state.version)
+        self.assertEqual(state_target, chat_state.state)
+        self.assertEqual({'state1': {'first': 1}, 'state2': {'second': 2}, 'state1_again': {'third': 3}}, chat_state.ctx)
+        
+    def test_chat_state_transition_dropped_when_state_changes(self):
+        state = factories.StateFactory(bot=self.bot, name="state1")
+        state_target = factories.StateFactory(bot=self.bot, name="state2")
+        other_state = factories.StateFactory(bot=self.bot, name="state3")
+        chat_state = factories.TelegramChatStateFactory(state=state)
+        stale_chat_state = TelegramChatState.objects.get(pk=chat_state.pk)
+        self.assertTrue(chat_state.compare_and_set(other_state, 'state1', {'first': 1}, self.bot))
+        self.assertFalse(stale_chat_state.compare_and_set(state_target, 'state1', {'second': 2}, self.bot))
+        chat_state = TelegramChatState.objects.get(pk=chat_state.pk)
+        self.assertEqual(1, chat_state.version)
+        self.assertEqual(other_state, chat_state.state)
+        self.assertEqual({'state1': {'first': 1}}, chat_state.ctx)
+
+    def test_chat_state_context_limits(self):
+        self.bot.context_max_states = 2
+        self.bot.context_response_fields = 'name'
+        state = factories.StateFactory(bot=self.bot, name="state1")
+        chat_state = factories.TelegramChatStateFactory(state=state)
+        for key in ('state1', 'state2', 'state3'):
+            chat_state.compare_and_set(state, key, {'response': {'data': [{'name': key, 'bio': 'long'}]}}, self.bot)
+        self.assertEqual(['state2', 'state3'], list(TelegramChatState.objects.get(pk=chat_state.pk).ctx))
+        self.assertEqual({'response': {'data': [{'name': 'state3'}]}}, chat_state.ctx['state3'])
+        self.bot.context_max_bytes = len(json.dumps(chat_state.ctx['state3']))
+        chat_state.compare_and_set(state, 'state4', {'response': {'data': {'name': 'state4'}}}, self.bot)
+        self.assertEqual({'state4': {'response': {'data': {'name': 'state4'}}}}, chat_state.ctx)
+
+    @override_settings(MICROBOT_CHAT_CONTEXT_COMPRESSION=True)
+    def test_chat_state_context_compressed(self):
+        context = {'state1': {'response': {'data': [{'name': 'author%d' % i} for i in range(100)]}}}
+        chat_state = factories.TelegramChatStateFactory(ctx=context)
+        chat_state = TelegramChatState.objects.get(pk=chat_state.pk)
+        self.assertLess(len(chat_state.context), len(json.dumps(context)))
+        self.assertEqual(context, chat_state.ctx)
+
+    def test_chat_state_context_decoded_once(self):
+        chat_state = factories.TelegramChatStateFactory(ctx={'state1': {'pattern': {}}})
+        chat_state = TelegramChatState.objects.get(pk=chat_state.pk)
+        with mock.patch('permabots.contexts.json.loads', wraps=json.loads) as mock_loads:
+            state_context = contexts.LazyContext(chat_state)
+            self.assertEqual(0, mock_loads.call_count)
+            self.assertEqual({'pattern': {}}, state_context['state1'])
+            self.assertEqual(['state1'], list(chat_state.ctx))
+            self.assertEqual(1, mock_loads.call_count)
+
+    def test_chat_state_cached(self):
+        chat = factories.TelegramChatAPIFactory()
+        user = factories.TelegramUserAPIFactory()
+        self.assertEqual(None, chat_states.get(TelegramChatState, self.bot, chat, user))
+        with self.assertNumQueries(0):
+            self.assertEqual(None, chat_states.get(TelegramChatState, self.bot, chat, user))
+        state = factories.StateFactory(bot=self.bot, name="state1")
+        chat_state = factories.TelegramChatStateFactory(chat=chat, user=user, state=state)
+        self.assertEqual(chat_state, chat_states.get(TelegramChatState, self.bot, chat, user))
+        state_target = factories.StateFactory(bot=self.bot, name="state2")
+        self.bot.update_chat_state(self.bot.telegram_bot, None, chat_state, state_target, {'first': 1})
+        with self.assertNumQueries(0):
+            cached = chat_states.get(TelegramChatState, self.bot, chat, user)
+            self.assertEqual(state_target, cached.state)
+            self.assertEqual({'state1': {'first': 1}}, cached.ctx)
+
+    @override_settings(MICROBOT_EPHEMERAL_MESSAGES=True)
+    def test_ephemeral_message(self):
+        self.handler = factories.HandlerFactory(bot=self.bot,
+                                                pattern="/authors",
+                                                request=None,
+                                                response__text_template="<b>author1</b>",
+                                                response__keyboard_template="")
+        with mock.patch(self.send_message_to_patch, callable=mock.MagicMock()) as mock_send:
+            self.set_text(self.author_get['in'], self.telegram_update)
+            response = self.client.post(self.webhook_url, self.to_send(self.telegram_update), **self.kwargs)
+            self.assertEqual(status.HTTP_200_OK, response.status_code)
+            self.assertBotResponse(mock_send, self.author_get)
+        self.assertEqual(0, TelegramUpdate.objects.count())
+        self.assertEqual(0, TelegramMessage.objects.count())
+        self.assertEqual(1, TelegramChat.objects.count())
                 
+    def test_telegram_user_name_updated(self):
+        self._test_message(self.author_get, no_handler=True)
+        self.telegram_update.update_id += 1
+        self.telegram_update.message.from_user.first_name = "renamed"
+        self._test_message(self.author_get, number=2, no_handler=True)
+        self.assertEqual("renamed", TelegramUser.objects.get(id=self.telegram_update.message.from_user.id).first_name)
+        self.assertEqual(1, TelegramUser.objects.count())
+        
     def test_telegram_no_text_message(self):
         update = json.loads(self.telegram_update.to_json())
         update['message'].pop('text')
@@ -121,6 +417,31 @@ class TestHandler(testcases.TelegramTestBot):
             return json.dumps(message.to_json())
         response = self.client.post(self.kik_webhook_url, to_send(self.kik_message), **self.kwargs)
         self.assertEqual(status.HTTP_403_FORBIDDEN, response.status_code)
+
+
+@skipIf(async_upstreams is None or sys.version_info < (3, 7), "Async requests require python 3.7 and httpx")
+class TestAsyncRequests(TestCase):
+    
+    def setUp(self):
+        self.request = factories.RequestFactory(url_template="http://api.example.com/authors")
+        # Parameters are loaded from database before running in the event loop
+        self.request.template_variables()
+        self.async_client_class = httpx.AsyncClient
+        self.clients = []
+        
+    def _build_client(self):
+        transport = httpx.MockTransport(lambda request: httpx.Response(200, json={'name': 'author1'}))
+        client = self.async_client_class(transport=transport)
+        self.clients.append(client)
+        return client
+        
+    def test_async_process_in_several_event_loops(self):
+        with mock.patch.object(httpx, 'AsyncClient', callable=mock.MagicMock(), side_effect=self._build_client):
+            for run in range(2):
+                response = asyncio.run(async_upstreams.process(self.request))
+                self.assertEqual({'name': 'author1'}, response.json())
+        self.assertEqual(2, len(self.clients))
+        self.assertTrue(all(client.is_closed for client in self.clients))
         
 class TestRequests(LiveServerTestCase, testcases.TelegramTestBot):
     
@@ -229,6 +550,13 @@ class TestRequests(LiveServerTestCase, testcases.TelegramTestBot):
                                           }
                                   }
     
+    request_failed = {'in': '/authors',
+                      'out': {'parse_mode': 'HTML',
+                              'reply_markup': '',
+                              'text': 'Not available'
+                              }
+                      }
+    
     no_request = {'in': '/norequest',
                   'out': {'parse_mode': 'HTML',
                           'reply_markup': '',
@@ -282,6 +610,22 @@ class TestRequests(LiveServerTestCase, testcases.TelegramTestBot):
                                                 response=self.response)
         self._test_message(self.author_get)
    
+    def test_get_request_cached(self):
+        Author.objects.create(name="author1")
+        self.request = factories.RequestFactory(url_template=self.live_server_url + '/api/authors/',
+                                                method=Request.GET,
+                                                cache_timeout=60)
+        self.response = factories.ResponseFactory(text_template='{% for author in response.data %}<b>{{author.name}}</b>{% endfor %}',
+                                                  keyboard_template='')
+        self.handler = factories.HandlerFactory(bot=self.bot,
+                                                pattern='/authors',
+                                                request=self.request,
+                                                response=self.response)
+        with mock.patch('permabots.upstreams.request', callable=mock.MagicMock(), wraps=upstreams.request) as mock_request:
+            self._test_message(self.author_get)
+            self._test_message(self.author_get)
+            self.assertEqual(1, mock_request.call_count)
+   
     def test_get_pattern_command(self):
         Author.objects.create(name="author1")
         self.request = factories.RequestFactory(url_template=self.live_server_url + '/api/authors/{{pattern.id}}/',
@@ -381,6 +725,33 @@ class TestRequests(LiveServerTestCase, testcases.TelegramTestBot):
                                                 response=self.response)
         self._test_message(self.author_get_with_url_parameters)
         
+    def test_request_parameters_snapshot(self):
+        Author.objects.create(name="author1")
+        Author.objects.create(name="author2")
+        self.request = factories.RequestFactory(url_template=self.live_server_url + '/api/authors/',
+                                                method=Request.GET)
+        self.url_param = factories.UrlParamFactory(request=self.request,
+                                                   key='name',
+                                                   value_template='{{pattern.name}}')
+        self.response = factories.ResponseFactory(text_template='{% for author in response.data %}<b>{{author.name}}</b>{% endfor %}',
+                                                  keyboard_template='')
+        self.handler = factories.HandlerFactory(bot=self.bot,
+                                                pattern='/authors_name@(?P<name>\w+)',
+                                                request=self.request,
+                                                response=self.response)
+        self._test_message(self.author_get_with_url_parameters)
+        with mock.patch('permabots.rendering.get_template', callable=mock.MagicMock(), wraps=rendering.get_template) as mock_get_template:
+            self._test_message(self.author_get_with_url_parameters)
+            self.assertEqual(0, mock_get_template.call_count)
+        self.url_param.value_template = 'author2'
+        self.url_param.save()
+        self._test_message({'in': '/authors_name@author1',
+                            'out': {'parse_mode': 'HTML',
+                                    'reply_markup': '',
+                                    'text': '<b>author2</b>'
+                                    }
+                            })
+        
     def test_header_parameters(self):
         # Unsupported media type 415. Author not created
         EnvironmentVar.objects.create(bot=self.bot,
@@ -498,6 +869,44 @@ class TestRequests(LiveServerTestCase, testcases.TelegramTestBot):
         author = Author.objects.all()[0]
         self.assertEqual(author.name, "author2")
         
+    def test_request_timeout(self):
+        self.bot.request_timeout = 2
+        self.bot.save()
+        self.request = factories.RequestFactory(url_template='http://slow.example.com/authors/',
+                                                method=Request.GET)
+        self.response = factories.ResponseFactory(text_template='{% if response.status == 504 %}Not available{% endif %}',
+                                                  keyboard_template='')
+        self.handler = factories.HandlerFactory(bot=self.bot,
+                                                pattern='/authors',
+                                                request=self.request,
+                                                response=self.response)
+        with mock.patch('requests.Session.request', callable=mock.MagicMock(), side_effect=requests.Timeout()) as mock_request:
+            self._test_message(self.request_failed)
+            self.assertEqual(2, mock_request.call_args[1]['timeout'])
+        self.request.timeout = 1
+        self.request.save()
+        self.handler.save()
+        with mock.patch('requests.Session.request', callable=mock.MagicMock(), side_effect=requests.Timeout()) as mock_request:
+            self._test_message(self.request_failed)
+            self.assertEqual(1, mock_request.call_args[1]['timeout'])
+            
+    def test_request_circuit_open(self):
+        self.request = factories.RequestFactory(url_template='http://down.example.com/authors/',
+                                                method=Request.GET)
+        self.response = factories.ResponseFactory(text_template='{% if response.status >= 500 %}Not available{% endif %}',
+                                                  keyboard_template='')
+        self.handler = factories.HandlerFactory(bot=self.bot,
+                                                pattern='/authors',
+                                                request=self.request,
+                                                response=self.response)
+        with override_settings(MICROBOT_CIRCUIT_BREAKER={'failures': 2}):
+            with mock.patch('requests.Session.request', callable=mock.MagicMock(), side_effect=requests.ConnectionError()) as mock_request:
+                self._test_message(self.request_failed)
+                self._test_message(self.request_failed)
+                self._test_message(self.request_failed)
+                self.assertEqual(2, mock_request.call_count)
+                self.assertRaises(upstreams.UpstreamError, upstreams.request, 'GET', 'http://down.example.com/books/')
+        
     def test_handler_with_state(self):
         Author.objects.create(name="author1")
         self.request = factories.RequestFactory(url_template=self.live_server_url + '/api/authors/',
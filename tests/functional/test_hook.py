@@ -2,7 +2,11 @@
 # -*- coding: utf-8 -*-
 from permabots.models import EnvironmentVar, Hook
 from permabots.test import factories, testcases
+from permabots import tasks
 from rest_framework import status
+from django.test import override_settings
+from django.core.cache import cache
+from django.core.urlresolvers import reverse
 try:
     from unittest import mock
 except ImportError:
@@ -80,7 +84,7 @@ class TestHook(testcases.TelegramTestBot):
                         error_to_check="JSON parse error")
         
     def test_hook_multiple_telegram_and_kik(self):
-        with mock.patch('kik.api.KikApi.send_messages', callable=mock.MagicMock()) as mock_kik_send:
+        with mock.patch('permabots.connections.KikClient.send_messages', callable=mock.MagicMock()) as mock_kik_send:
             self._test_hook(self.hook_name, '{"name": "juan"}', num_recipients=1, recipients=[self.telegram_recipient.chat_id],
                             auth=self._gen_token(self.hook.bot.owner.auth_token))
             recipients = [self.kik_recipient.chat_id]
@@ -93,7 +97,7 @@ class TestHook(testcases.TelegramTestBot):
             self.assertEqual([], recipients)
             
     def test_hook_multiple_telegram_and_messenger(self):
-        with mock.patch('messengerbot.MessengerClient.send', callable=mock.MagicMock()) as mock_messenger_send:
+        with mock.patch('permabots.connections.MessengerBotClient.send', callable=mock.MagicMock()) as mock_messenger_send:
             self._test_hook(self.hook_name, '{"name": "juan"}', num_recipients=1, recipients=[self.telegram_recipient.chat_id],
                             auth=self._gen_token(self.hook.bot.owner.auth_token))
             recipients = [self.messenger_recipient.chat_id]
@@ -102,3 +106,66 @@ class TestHook(testcases.TelegramTestBot):
             message = args[0]
             recipients.remove(message.recipient.recipient_id)
             self.assertIn("juan", message.message.attachment.template.elements[0].title)
+            
+    def test_hook_kik_recipients_in_one_request(self):
+        recipients = [self.kik_recipient.chat_id, 
+                      factories.KikRecipientFactory(hook=self.hook).chat_id,
+                      factories.KikRecipientFactory(hook=self.hook).chat_id]
+        with mock.patch('permabots.connections.KikClient.send_messages', callable=mock.MagicMock()) as mock_kik_send:
+            self._test_hook(self.hook_name, '{"name": "juan"}', num_recipients=1, recipients=[self.telegram_recipient.chat_id],
+                            auth=self._gen_token(self.hook.bot.owner.auth_token))
+            self.assertEqual(1, mock_kik_send.call_count)
+            args, kwargs = mock_kik_send.call_args
+            self.assertEqual(sorted(recipients), sorted(message.chat_id for message in args[0]))
+            
+    def test_hook_kik_request_split_when_fails(self):
+        new_recipient = factories.KikRecipientFactory(hook=self.hook)
+        
+        def send_messages(messages):
+            if self.kik_recipient.chat_id in [message.chat_id for message in messages]:
+                raise Exception("Not valid user")
+            
+        with mock.patch('permabots.connections.KikClient.send_messages', callable=mock.MagicMock(), side_effect=send_messages) as mock_kik_send:
+            self._test_hook(self.hook_name, '{"name": "juan"}', num_recipients=1, recipients=[self.telegram_recipient.chat_id],
+                            auth=self._gen_token(self.hook.bot.owner.auth_token))
+            self.assertEqual(3, mock_kik_send.call_count)
+            self.assertFalse(self.hook.deliveries.get(chat_id=self.kik_recipient.chat_id).success)
+            self.assertTrue(self.hook.deliveries.get(chat_id=new_recipient.chat_id).success)
+            
+    def test_hook_deliveries(self):
+        self._test_hook(self.hook_name, '{"name": "juan"}', num_recipients=1, recipients=[self.telegram_recipient.chat_id],
+                        auth=self._gen_token(self.hook.bot.owner.auth_token))
+        delivery = self.hook.deliveries.get(service='telegram')
+        self.assertEqual(delivery.chat_id, str(self.telegram_recipient.chat_id))
+        self.assertTrue(delivery.success)
+        
+    @override_settings(MICROBOT_HOOK_CHUNK_SIZE=1)
+    def test_hook_recipients_in_chunks(self):
+        new_recipient = factories.TelegramRecipientFactory(hook=self.hook)
+        with mock.patch("permabots.tasks.handle_hook_recipients.apply_async", callable=mock.MagicMock()) as mock_apply:
+            response = self.client.post(reverse('permabots:hook', kwargs={'key': self.hook.key}), '{"name": "juan"}',
+                                        HTTP_AUTHORIZATION=self._gen_token(self.hook.bot.owner.auth_token), **self.kwargs)
+            self.assertEqual(response.status_code, status.HTTP_200_OK)
+            chunks = [args[0][2] for args, kwargs in mock_apply.call_args_list if args[0][1] == 'telegram']
+            self.assertEqual(2, len(chunks))
+            self.assertEqual(set([self.telegram_recipient.id, new_recipient.id]), set(chunk[0] for chunk in chunks))
+            
+    @override_settings(MICROBOT_RATE_LIMITS={'telegram': 1})
+    def test_hook_recipients_throttled_sent_again(self):
+        new_recipient = factories.TelegramRecipientFactory(hook=self.hook)
+        with mock.patch("telegram.bot.Bot.send_message", callable=mock.MagicMock()) as mock_send:
+            retry = tasks.handle_hook_recipients.retry
+            
+            def retry_after_countdown(**kwargs):
+                # Eager retries run at once ignoring countdown. Rate limit window is over after it
+                cache.clear()
+                return retry(**kwargs)
+            
+            with mock.patch.object(tasks.handle_hook_recipients, 'retry', side_effect=retry_after_countdown) as mock_retry:
+                tasks.handle_hook_recipients.apply((self.hook.id, 'telegram', [self.telegram_recipient.id, new_recipient.id],
+                                                    '<b>juan</b>', None))
+                self.assertEqual(1, mock_retry.call_count)
+                self.assertTrue(0 < mock_retry.call_args[1]['countdown'] <= 1)
+            self.assertEqual([self.telegram_recipient.chat_id, new_recipient.chat_id],
+                             [kwargs['chat_id'] for args, kwargs in mock_send.call_args_list])
+        self.assertEqual(2, self.hook.deliveries.filter(service='telegram', success=True).count())